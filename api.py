@@ -1,14 +1,79 @@
-from fastapi import FastAPI, HTTPException, Request, Response
+from startup import startup
+from fastapi import FastAPI, Header, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Any, Dict, Optional
-import uvicorn
-import base64
-from io import BytesIO
-from agents_helper.ag2 import AgentState as State
+from contextlib import asynccontextmanager
+from functools import lru_cache
+import asyncio
+import os
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from agents_helper.ob_agent import OnboardingAgent, AgentState
+from session_store import SessionStore, SessionNotFound, SESSION_DB_PATH
+from session_backend import SessionConflict
+from streaming import stream_graph, sse, last_assistant_message
+from summary_jobs import SummaryScheduler
+from rag_jobs import RAGJobRunner, RAGJobNotFound
+from instrumentation import metrics
+from llm import gateway
+from llm_gateway import DEFAULT_TENANT, current_tenant, tenant
+from embedding_cache import cached_embeddings
+from vector_store import vector_stores
+from tool_registry import tool_registry
 
-app = FastAPI()
+startup.mark("imports")
+
+# Warm-up runs in the background after startup; /ready answers 503 until it is done
+API_WARM_UP = os.getenv("API_WARM_UP", "1") == "1"
+API_RELOAD = os.getenv("API_RELOAD", "0") == "1"
+
+sessions: Optional[SessionStore] = None
+summaries: Optional[SummaryScheduler] = None
+rag_jobs: Optional[RAGJobRunner] = None
+
+async def store_rag_results(session_id: str, output: Dict[str, Any]):
+    try:
+        state = await sessions.get_state(session_id)
+    except SessionNotFound:
+        return
+    output = await get_agent().with_pre_answers(output, state.get("namespace"))
+    await sessions.apply_update(session_id, output, as_node="RAGBasedAgent")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global sessions, summaries, rag_jobs
+    async with AsyncSqliteSaver.from_conn_string(SESSION_DB_PATH) as checkpointer:
+        # Session turns return as soon as the user-facing node is done; summaries follow in the background
+        session_agent = OnboardingAgent(checkpointer=checkpointer, defer_summary=True)
+        sessions = SessionStore(session_agent.graph)
+        summaries = SummaryScheduler(sessions, session_agent, AgentState)
+        eviction = asyncio.create_task(sessions.run_eviction())
+        # Analyses cut short by a restart continue from their last checkpointed iteration
+        rag_jobs = RAGJobRunner(on_complete=store_rag_results)
+        rag_jobs.resume()
+        leases = asyncio.create_task(rag_jobs.run_leases())
+        startup.mark("lifespan")
+        warm_up = None
+        if API_WARM_UP:
+            warm_up = asyncio.create_task(startup.warm_up({
+                "topics": session_agent.warm_up,
+                "graph": get_agent,
+                "llm_pool": gateway.warm_up,
+                "embeddings": lambda: cached_embeddings.model,
+                "vector_store": vector_stores.get_store,
+                "tools": tool_registry.warm_up,
+            }))
+        else:
+            startup.finish()
+        yield
+        if warm_up is not None:
+            warm_up.cancel()
+        eviction.cancel()
+        leases.cancel()
+    await gateway.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS middleware to allow requests from any origin
 app.add_middleware(
@@ -19,28 +84,186 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-agent = OnboardingAgent()
+@app.middleware("http")
+async def bind_tenant(request: Request, call_next):
+    # LLM concurrency is shared per tenant: the X-Tenant-ID header, else the session in the path
+    tenant_id = request.headers.get("X-Tenant-ID")
+    if not tenant_id and request.url.path.startswith("/sessions/"):
+        tenant_id = request.url.path.split("/")[2]
+    with tenant(tenant_id):
+        return await call_next(request)
+
+@lru_cache(maxsize=1)
+def get_agent() -> OnboardingAgent:
+    # The stateless agent's graph is compiled once per worker, during warm-up or on first use
+    return OnboardingAgent()
+
+def bound_namespace() -> Optional[str]:
+    # Documents are searched in the tenant's index (X-Tenant-ID, else the session; see bind_tenant), never in
+    # one named by the client's state
+    tenant_id = current_tenant.get()
+    return None if tenant_id == DEFAULT_TENANT else tenant_id
+
+class TurnRequest(BaseModel):
+    query: str = ""
+    updates: Dict[str, Any] = {}
+    # Version the client last saw; a turn against an older one is rejected with 409
+    version: Optional[int] = None
+
+class RAGJobRequest(BaseModel):
+    session_id: Optional[str] = None
 
 @app.post("/invoke")
-def invoke_agent(request: AgentState):
-    payload = request.dict()
-    print(f"Received payload: {payload}")
+async def invoke_agent(request: AgentState):
+    payload = {**request.dict(), "namespace": bound_namespace()}
     try:
         # Invoke the compiled state graph. The compiled graph accepts plain dict input.
-        result = agent.graph.invoke(payload)
+        result = await get_agent().graph.ainvoke(payload)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
     return {"result": result}
 
-@app.post("/get_rag_agent")
-def get_rag_agent():
+@app.post("/invoke/stream")
+async def invoke_agent_stream(request: AgentState):
+    async def events():
+        try:
+            async for event in stream_graph(get_agent().graph, {**request.dict(), "namespace": bound_namespace()}, user_facing_nodes=OnboardingAgent.USER_FACING_NODES):
+                yield sse(event.pop("event"), event)
+        except Exception as e:
+            yield sse("error", {"detail": str(e)})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/sessions")
+async def create_session():
+    return {"session_id": await sessions.create()}
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    try:
+        state = await sessions.get_state(session_id)
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail=f"Unknown session '{session_id}'")
+    return {"session_id": session_id, "state": state, "version": await sessions.version(session_id)}
+
+def turn_updates(request: TurnRequest) -> Dict[str, Any]:
+    return {**request.updates, "namespace": bound_namespace()}
+
+def turn_response(session_id: str, state: Dict[str, Any], version: int) -> Dict[str, Any]:
+    return {"session_id": session_id, "reply": last_assistant_message(state.get("context_history", [])), "summary": state.get("summary", ""), "summary_pending": True, "version": version}
+
+async def replayed_turn(session_id: str, idempotency_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    # A retried request with the same Idempotency-Key gets the stored response instead of a second turn
     try:
-        rag_agent = agent.rag_based_agent({})
-        return {"summary": rag_agent.get("RAG_summary", ""),"unanswered_questions": rag_agent.get("unanswered_questions", [])}
+        await sessions.get_state(session_id)
+        return await sessions.reserve_turn(session_id, idempotency_key)
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail=f"Unknown session '{session_id}'")
+    except SessionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.post("/sessions/{session_id}/turn")
+async def session_turn(session_id: str, request: TurnRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    replay = await replayed_turn(session_id, idempotency_key)
+    if replay is not None:
+        return replay
+    try:
+        result, version = await sessions.run_turn(session_id, request.query, turn_updates(request), request.version)
+    except SessionNotFound:
+        await sessions.abandon_turn(session_id, idempotency_key)
+        raise HTTPException(status_code=404, detail=f"Unknown session '{session_id}'")
+    except SessionConflict as e:
+        await sessions.abandon_turn(session_id, idempotency_key)
+        raise HTTPException(status_code=409, detail=str(e))
     except Exception as e:
+        await sessions.abandon_turn(session_id, idempotency_key)
         raise HTTPException(status_code=500, detail=str(e))
 
+    response = turn_response(session_id, result, version)
+    await sessions.complete_turn(session_id, idempotency_key, response)
+    summaries.schedule(session_id)
+    return response
+
+@app.post("/sessions/{session_id}/turn/stream")
+async def session_turn_stream(session_id: str, request: TurnRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    replay = await replayed_turn(session_id, idempotency_key)
+    version = await sessions.version(session_id)
+    if replay is None and request.version is not None and request.version != version:
+        # Stale clients get a real 409 here; a conflict found once streaming has started can only be an error event
+        await sessions.abandon_turn(session_id, idempotency_key)
+        raise HTTPException(status_code=409, detail=f"Session {session_id} is at version {version}, not {request.version}")
+
+    async def events():
+        if replay is not None:
+            yield sse("end", replay)
+            return
+        completed = False
+        try:
+            async for event in sessions.stream_turn(session_id, request.query, turn_updates(request), OnboardingAgent.USER_FACING_NODES, request.version):
+                if event["event"] == "end":
+                    event.update(turn_response(session_id, event.pop("state"), event.pop("version")))
+                    response = {key: value for key, value in event.items() if key != "event"}
+                    await sessions.complete_turn(session_id, idempotency_key, response)
+                    completed = True
+                    summaries.schedule(session_id)
+                yield sse(event.pop("event"), event)
+        except SessionConflict as e:
+            yield sse("error", {"detail": str(e), "status": 409})
+        except Exception as e:
+            yield sse("error", {"detail": str(e)})
+        finally:
+            if not completed:
+                await sessions.abandon_turn(session_id, idempotency_key)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/sessions/{session_id}/summary")
+async def get_session_summary(session_id: str, wait: bool = False):
+    try:
+        if wait:
+            await summaries.wait(session_id)
+        state = await sessions.get_state(session_id)
+    except SessionNotFound:
+        raise HTTPException(status_code=404, detail=f"Unknown session '{session_id}'")
+
+    return {"session_id": session_id, "summary": state.get("summary", ""), "summary_pending": summaries.pending(session_id)}
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    await sessions.delete(session_id)
+    return {"session_id": session_id, "deleted": True}
+
+@app.get("/ready")
+async def ready():
+    return JSONResponse(startup.as_dict(), status_code=200 if startup.ready else 503)
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.post("/get_rag_agent")
+async def get_rag_agent(request: Optional[RAGJobRequest] = None):
+    session_id = request.session_id if request else None
+    if session_id:
+        try:
+            await sessions.get_state(session_id)
+        except SessionNotFound:
+            raise HTTPException(status_code=404, detail=f"Unknown session '{session_id}'")
+
+    job_id = rag_jobs.submit(session_id)
+    return {"job_id": job_id, "status": rag_jobs.status(job_id)["status"]}
+
+@app.get("/rag_jobs/{job_id}")
+async def get_rag_job(job_id: str, wait: bool = False):
+    try:
+        return await rag_jobs.wait(job_id) if wait else rag_jobs.status(job_id)
+    except RAGJobNotFound:
+        raise HTTPException(status_code=404, detail=f"Unknown job '{job_id}'")
+
 if __name__ == "__main__":
     # Run with: python ob_app.py
-    uvicorn.run("ob_app:app", host="0.0.0.0", port=8000, reload=True)
+    import uvicorn
+
+    # Reloading re-imports everything on each change; only for local development (API_RELOAD=1)
+    uvicorn.run("ob_app:app", host="0.0.0.0", port=8000, reload=API_RELOAD)
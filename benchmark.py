@@ -0,0 +1,281 @@
+"""Offline benchmark of both onboarding graphs against a deterministic fake LLM.
+
+    python benchmark.py                      # run and write benchmark_results.json
+    python benchmark.py --save-baseline      # also store the results as the baseline
+    python benchmark.py --check              # exit 1 if anything regressed against the baseline
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+import uuid
+from typing import Any, Dict, List, Optional, Tuple, Union, get_args, get_origin
+
+import logging
+from logging import getLogger
+
+from pydantic import BaseModel, Field
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+from langgraph.checkpoint.memory import InMemorySaver
+
+import llm as llm_module
+from instrumentation import current_node
+from token_budget import count_tokens
+
+logger = getLogger("benchmark")
+logger.setLevel(logging.DEBUG)
+
+RESULTS_PATH = "benchmark_results.json"
+BASELINE_PATH = "benchmark_baseline.json"
+DEFAULT_LATENCY = 0.02
+# Relative growth tolerated before a metric counts as a regression
+TOLERANCE = {"wall_ms_mean": 0.25, "prompt_tokens": 0.05, "state_bytes": 0.05, "peak_alloc_kb": 0.25}
+
+SCENARIOS = {
+    "onboarding_agent": [
+        "I want an agent that triages our support inbox",
+        "We are a 20 person SaaS company selling scheduling software to clinics",
+        "The support team would use it, it should read Gmail and open GitHub issues for bugs",
+        "It should escalate angry customers to a human",
+        "Yes, that looks right",
+        "Please also add Google Drive search",
+    ],
+    "with_RAG": [
+        "Hi, I run a logistics startup",
+        "We move freight for small e-commerce brands across Europe",
+        "Our customers are Shopify merchants doing 1-10k orders a month",
+        "We charge per shipment plus a monthly platform fee",
+        "The ops team is 12 people and uses Notion, Slack and HubSpot",
+        "Yes, that summary is correct",
+    ],
+}
+
+
+def fake_value(annotation, name: str, truthy: bool):
+    origin = get_origin(annotation)
+    if annotation is bool:
+        return truthy
+    if annotation is str:
+        return f"Fake {name.replace('_', ' ')}."
+    if annotation is int:
+        return 0
+    if annotation is float:
+        return 1.0 if truthy else 0.0
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return fake_instance(annotation, truthy)
+    if origin in (list, List):
+        return []
+    if origin in (dict, Dict):
+        return {}
+    if origin is Union:
+        return fake_value(next(arg for arg in get_args(annotation) if arg is not type(None)), name, truthy)
+    return None
+
+
+def fake_instance(schema, truthy: bool):
+    return schema(**{name: fake_value(field.annotation, name, truthy) for name, field in schema.model_fields.items()})
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic stand-in for the OpenAI chat model.
+
+    Structured outputs are valid instances of the requested schema. Boolean fields stay False for the
+    first `satisfy_after` calls with a schema and are True afterwards, so scripted conversations move
+    through every stage of the graphs.
+    """
+
+    model_name: str = "fake-chat"
+    latency: float = DEFAULT_LATENCY
+    satisfy_after: int = 2
+    calls: Dict[str, int] = Field(default_factory=dict)
+    prompts: List[Tuple[str, str]] = Field(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _record(self, kind: str, messages) -> int:
+        prompt = messages if isinstance(messages, str) else "\n".join(str(message.content) for message in messages)
+        self.prompts.append((current_node(), prompt))
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        return self.calls[kind]
+
+    def _reply(self, messages) -> ChatResult:
+        self._record("text", messages)
+        prompt = str(messages[-1].content)
+        content = "ToolModification" if "RoleModification" in prompt else "Could you tell me more about your business and the team this agent will support?"
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content))])
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(self.latency)
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        await asyncio.sleep(self.latency)
+        return self._reply(messages)
+
+    def with_structured_output(self, schema, **kwargs):
+        def respond(messages):
+            time.sleep(self.latency)
+            return fake_instance(schema, self._record(schema.__name__, messages) > self.satisfy_after)
+
+        async def arespond(messages):
+            await asyncio.sleep(self.latency)
+            return fake_instance(schema, self._record(schema.__name__, messages) > self.satisfy_after)
+
+        return RunnableLambda(respond, afunc=arespond)
+
+
+def install_fake_llm(fake: FakeChatModel):
+    """Routes every LLM call, which all go through the gateway, to the fake."""
+    llm_module.gateway.llm = fake
+    # The fake has no rate limit to respect, and throttling would only measure the bucket
+    llm_module.gateway.rate_per_second = float("inf")
+
+
+async def run_scenario(name: str, fake: FakeChatModel, use_cache: bool = False) -> Dict[str, Any]:
+    import prompt_encoding
+    from llm_cache import response_cache
+    from prompt_encoding import template_report, token_report
+    from token_budget import tokens_saved
+    from session_store import state_size
+
+    if name == "with_RAG":
+        import with_RAG as module
+
+        first_turn = {"documents_uploaded": False}
+    else:
+        import onboarding_agent as module
+
+        first_turn = {}
+    install_fake_llm(fake)
+    prompt_encoding.PROMPT_TOKEN_REPORT = True
+    if not use_cache:
+        response_cache.nodes = set()
+
+    agent = module.OnboardingAgent(checkpointer=InMemorySaver())
+    if hasattr(agent, "intent_model"):
+        # No learning from benchmark traffic and no random shadow calls
+        agent.intent_model.log_path = None
+        agent.intent_model.shadow_sample_rate = 0.0
+    config = {"configurable": {"thread_id": uuid.uuid4().hex}}
+
+    nodes: Dict[str, Dict[str, float]] = {}
+    started: Dict[str, float] = {}
+    peak = 0
+    fake.prompts.clear()
+    template_report.clear()
+    tokens_saved.clear()
+    tracemalloc.start()
+    began = time.perf_counter()
+    for turn, query in enumerate(SCENARIOS[name]):
+        tracemalloc.reset_peak()
+        payload = {**(first_turn if turn == 0 else {}), "query": query}
+        async for event in agent.graph.astream_events(payload, config, version="v2"):
+            node = event.get("metadata", {}).get("langgraph_node")
+            if node != event["name"] or node == "__start__":
+                continue
+            if event["event"] == "on_chain_start":
+                started[event["run_id"]] = time.perf_counter()
+            elif event["event"] == "on_chain_end" and event["run_id"] in started:
+                stats = nodes.setdefault(node, {"calls": 0, "wall_ms_total": 0.0, "prompt_chars": 0, "prompt_tokens": 0})
+                stats["calls"] += 1
+                stats["wall_ms_total"] += (time.perf_counter() - started.pop(event["run_id"])) * 1000
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+    total_ms = (time.perf_counter() - began) * 1000
+    tracemalloc.stop()
+
+    for node, prompt in fake.prompts:
+        stats = nodes.setdefault(node or "unknown", {"calls": 0, "wall_ms_total": 0.0, "prompt_chars": 0, "prompt_tokens": 0})
+        stats["prompt_chars"] += len(prompt)
+        stats["prompt_tokens"] += count_tokens(prompt)
+    for stats in nodes.values():
+        stats["wall_ms_total"] = round(stats["wall_ms_total"], 2)
+        stats["wall_ms_mean"] = round(stats["wall_ms_total"] / stats["calls"], 2) if stats["calls"] else 0.0
+
+    state = (await agent.graph.aget_state(config)).values
+    return {
+        "turns": len(SCENARIOS[name]),
+        "total_ms": round(total_ms, 2),
+        "llm_calls": len(fake.prompts),
+        "prompt_tokens": sum(stats["prompt_tokens"] for stats in nodes.values()),
+        "state_bytes": state_size(state),
+        "peak_alloc_kb": round(peak / 1024, 1),
+        "nodes": dict(sorted(nodes.items())),
+        **token_report(),
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    regressions = []
+
+    def check(label: str, metric: str, current: float, previous: Optional[float]):
+        if previous is None:
+            return
+        # Tiny absolute changes are noise, whatever the ratio
+        if current > previous * (1 + TOLERANCE[metric]) and current - previous > 1:
+            regressions.append(f"{label} {metric}: {previous} -> {current}")
+
+    for scenario, result in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(scenario)
+        if previous is None:
+            continue
+        for metric in ("prompt_tokens", "state_bytes", "peak_alloc_kb"):
+            check(scenario, metric, result[metric], previous.get(metric))
+        for node, stats in result["nodes"].items():
+            old = previous["nodes"].get(node, {})
+            check(f"{scenario}.{node}", "wall_ms_mean", stats["wall_ms_mean"], old.get("wall_ms_mean"))
+            check(f"{scenario}.{node}", "prompt_tokens", stats["prompt_tokens"], old.get("prompt_tokens"))
+    return regressions
+
+
+async def main(args) -> int:
+    results = {"latency": args.latency, "scenarios": {}}
+    for name in args.scenarios:
+        fake = FakeChatModel(latency=args.latency)
+        results["scenarios"][name] = await run_scenario(name, fake, use_cache=args.cache)
+        result = results["scenarios"][name]
+        print(f"{name}: {result['total_ms']:.0f} ms, {result['llm_calls']} LLM calls, {result['prompt_tokens']} prompt tokens, state {result['state_bytes']} bytes, peak {result['peak_alloc_kb']} KiB")
+        for node, stats in result["nodes"].items():
+            print(f"  {node:<24} {stats['calls']:>3} calls {stats['wall_ms_mean']:>9.2f} ms {stats['prompt_tokens']:>7} tokens")
+        for template, report in result["templates"].items():
+            print(f"  {template:<32} {report['before']:>8.1f} -> {report['after']:>8.1f} tokens per call ({report['saved_pct']}% saved)")
+        for node, saved in result["history_saved"].items():
+            print(f"  {node:<32} {saved:>8} history tokens trimmed")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+
+    if args.check:
+        try:
+            with open(args.baseline, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"No baseline at {args.baseline}, run with --save-baseline first")
+            return 1
+        regressions = compare(results, baseline)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="seconds the fake LLM waits per call")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM response cache enabled")
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    sys.exit(asyncio.run(main(parser.parse_args())))
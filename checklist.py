@@ -0,0 +1,87 @@
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from pydantic import BaseModel, create_model
+
+MAX_EXTRA_CATEGORIES = 3
+# Terms shared by more than this fraction of categories say nothing about which one a message touches
+MAX_TERM_SPREAD = 0.2
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it", "of", "on",
+    "or", "our", "the", "their", "to", "we", "what", "with", "your", "details", "plans", "information",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [term for term in re.findall(r"[a-z0-9]+", (text or "").replace("_", " ").lower()) if term not in STOPWORDS]
+
+
+def full_mask(size: int) -> int:
+    return (1 << size) - 1
+
+
+def to_mask(checklist: BaseModel, fields: Sequence[str]) -> int:
+    mask = 0
+    for index, field in enumerate(fields):
+        if getattr(checklist, field, False):
+            mask |= 1 << index
+    return mask
+
+
+def is_complete(mask: int, size: int) -> bool:
+    return mask & full_mask(size) == full_mask(size)
+
+
+def next_open(mask: int, size: int) -> Optional[int]:
+    """Index of the lowest unset bit, or None when every category is covered."""
+    open_bits = ~mask & full_mask(size)
+    if not open_bits:
+        return None
+    return (open_bits & -open_bits).bit_length() - 1
+
+
+def bit_indices(bits: int) -> List[int]:
+    indices = []
+    while bits:
+        lowest = bits & -bits
+        indices.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return indices
+
+
+@lru_cache(maxsize=256)
+def partial_schema(name: str, fields: Tuple[str, ...]) -> type:
+    """Structured-output model with only the given checklist fields, so the LLM returns just those booleans."""
+    return create_model(name, **{field: (bool, False) for field in fields})
+
+
+class CategoryPrefilter:
+    """Keyword index from checklist categories and their topics.json subtopics to bit positions."""
+
+    def __init__(self, fields: Sequence[str], subtopics: Dict[str, Iterable[str]]):
+        self.fields = tuple(fields)
+        postings: Dict[str, int] = {}
+        for index, field in enumerate(self.fields):
+            terms = set(tokenize(field))
+            topics = subtopics.get(field) or []
+            if isinstance(topics, str):
+                topics = [topics]
+            for topic in topics:
+                terms.update(tokenize(topic))
+            for term in terms:
+                postings[term] = postings.get(term, 0) | (1 << index)
+
+        limit = max(1, int(len(self.fields) * MAX_TERM_SPREAD))
+        self.postings = {term: bits for term, bits in postings.items() if bin(bits).count("1") <= limit}
+
+    def candidates(self, text: str, mask: int, limit: int = MAX_EXTRA_CATEGORIES) -> List[int]:
+        """Open categories the text plausibly touches, most keyword hits first."""
+        open_bits = ~mask & full_mask(len(self.fields))
+        hits: Dict[int, int] = {}
+        for term in set(tokenize(text)):
+            bits = self.postings.get(term, 0) & open_bits
+            for index in bit_indices(bits):
+                hits[index] = hits.get(index, 0) + 1
+        return sorted(hits, key=lambda index: (-hits[index], index))[:limit]
@@ -0,0 +1,265 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+logger = getLogger("embedding_cache")
+logger.setLevel(logging.DEBUG)
+
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+EMBEDDING_MATRIX_PATH = "embedding_cache.f32"
+MAX_CACHED_EMBEDDINGS = 200_000
+GROWTH_ROWS = 4096
+# A reserved row whose vector is not written after this long belongs to a process that died
+RESERVATION_SECONDS = 60
+# Hits note their time in memory; last_used is written once this many have piled up
+EMBEDDING_TOUCH_BATCH = 64
+
+
+class EmbeddingStore:
+    """Vectors in a memory-mapped float32 matrix, with SQLite mapping content keys to rows.
+
+    Once max_entries rows are in use, new vectors take over the rows of the least recently used keys.
+    Processes sharing the files reserve rows in a SQLite write transaction, write their vectors, and
+    only then mark the rows ready for readers.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, matrix_path: str = EMBEDDING_MATRIX_PATH, max_entries: int = MAX_CACHED_EMBEDDINGS):
+        self.path = path
+        self.matrix_path = matrix_path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+        self._matrix: Optional[np.memmap] = None
+        self._touched: Dict[str, float] = {}
+        self.dim: Optional[int] = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL, ready INTEGER NOT NULL DEFAULT 1)")
+            if "ready" not in {column[1] for column in self._conn.execute("PRAGMA table_info(embeddings)")}:
+                self._conn.execute("ALTER TABLE embeddings ADD COLUMN ready INTEGER NOT NULL DEFAULT 1")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+            self.dim = row[0] if row else None
+        return self._conn
+
+    def _rows(self) -> int:
+        if not self.dim or not os.path.exists(self.matrix_path):
+            return 0
+        return os.path.getsize(self.matrix_path) // (4 * self.dim)
+
+    def _open(self, rows: int):
+        if self._rows() < rows:
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(rows * 4 * self.dim)
+        self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(self._rows(), self.dim))
+
+    def _reset(self, dim: int):
+        # A different embedding width means a different model; start over
+        logger.info("Embedding width changed to %d, clearing the cache", dim)
+        self._matrix = None
+        if os.path.exists(self.matrix_path):
+            os.remove(self.matrix_path)
+        self.conn.execute("DELETE FROM embeddings")
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (dim,))
+        self.dim = dim
+
+    def _slots(self, keys: List[str]) -> Dict[str, int]:
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            found.update(self.conn.execute(
+                f"SELECT key, slot FROM embeddings WHERE ready = 1 AND key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall())
+        return found
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        if not keys:
+            return {}
+        with self._lock:
+            found = self._slots(keys)
+            if not found or not self._rows():
+                return {}
+            if self._matrix is None or max(found.values()) >= len(self._matrix):
+                # Another process may have grown the matrix since it was mapped
+                self._open(0)
+            vectors = {key: np.array(self._matrix[slot]) for key, slot in found.items() if slot < len(self._matrix)}
+            # A row evicted and rewritten by another process while it was read no longer maps to its key
+            current = self._slots(list(vectors))
+            vectors = {key: vector for key, vector in vectors.items() if current.get(key) == found[key]}
+            now = time.time()
+            self._touched.update((key, now) for key in vectors)
+            if len(self._touched) >= EMBEDDING_TOUCH_BATCH:
+                self._flush_touched()
+        return vectors
+
+    def _flush_touched(self):
+        touched, self._touched = self._touched, {}
+        if touched:
+            self.conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(used, key) for key, used in touched.items()])
+            self.conn.commit()
+
+    def put_many(self, vectors: Dict[str, np.ndarray]):
+        if not vectors:
+            return
+        dim = len(next(iter(vectors.values())))
+        with self._lock:
+            # Eviction picks rows by last_used, so recent hits are recorded first
+            self._flush_touched()
+            slots, vectors = self._reserve(vectors, dim)
+            if not vectors:
+                return
+            for slot, vector in zip(slots, vectors.values()):
+                self._matrix[slot] = vector
+            self._matrix.flush()
+            # Vectors are on disk before readers are pointed at them
+            self.conn.executemany("UPDATE embeddings SET ready = 1 WHERE key = ? AND slot = ?", list(zip(vectors, slots)))
+            self.conn.commit()
+
+    def _reserve(self, vectors: Dict[str, np.ndarray], dim: int) -> Tuple[List[int], Dict[str, np.ndarray]]:
+        """Rows for the keys not stored yet, taken in one write transaction so no two processes get the same slot."""
+        conn = self.conn
+        conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+            if (row[0] if row else None) != self.dim:
+                # Another process changed the width since the matrix was mapped
+                self.dim, self._matrix = (row[0] if row else None), None
+            if self.dim != dim:
+                self._reset(dim)
+
+            # Another caller may have stored the same content in the meantime
+            existing = set()
+            keys = list(vectors)
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                existing.update(key for (key,) in conn.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+            vectors = dict([(key, vector) for key, vector in vectors.items() if key not in existing][-self.max_entries:])
+            if not vectors:
+                conn.commit()
+                return [], {}
+
+            now = time.time()
+            next_slot = conn.execute("SELECT COALESCE(MAX(slot) + 1, 0) FROM embeddings").fetchone()[0]
+            fresh = list(range(next_slot, min(self.max_entries, next_slot + len(vectors))))
+            evicted = []
+            if len(fresh) < len(vectors):
+                # Rows still being written by another process are left alone unless it died mid-write
+                evicted = conn.execute(
+                    "SELECT key, slot FROM embeddings WHERE ready = 1 OR last_used < ? ORDER BY last_used LIMIT ?",
+                    (now - RESERVATION_SECONDS, len(vectors) - len(fresh)),
+                ).fetchall()
+                conn.executemany("DELETE FROM embeddings WHERE key = ?", [(key,) for key, _ in evicted])
+            slots = fresh + [slot for _, slot in evicted]
+            vectors = dict(list(vectors.items())[:len(slots)])
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, slot, last_used, ready) VALUES (?, ?, ?, 0)",
+                [(key, slot, now) for key, slot in zip(vectors, slots)],
+            )
+            if vectors and (self._matrix is None or len(self._matrix) < (max(slots) + 1)):
+                # The matrix only grows, and only inside the transaction, so processes never shrink it under each other
+                self._matrix = None
+                self._open(min(self.max_entries, max(max(slots) + 1, 2 * self._rows(), GROWTH_ROWS)))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return slots, vectors
+
+def default_embeddings() -> Embeddings:
+    # Importing the RAG utilities connects their embedding client, so that waits for the first embedding
+    from requirements_agent.utils.rag import embeddings
+
+    return embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that looks vectors up by a hash of (model, kind, text) before calling the model.
+
+    Without `inner`, the RAG utilities' embeddings are loaded on first use.
+    """
+
+    def __init__(self, inner: Optional[Embeddings] = None, store: Optional[EmbeddingStore] = None):
+        self._inner = inner
+        self._model = None
+        self.store = store or EmbeddingStore()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def inner(self) -> Embeddings:
+        if self._inner is None:
+            self._inner = default_embeddings()
+        return self._inner
+
+    @property
+    def model(self) -> str:
+        if self._model is None:
+            inner = self.inner
+            self._model = getattr(inner, "model", None) or getattr(inner, "model_name", None) or type(inner).__name__
+        return self._model
+
+    def key(self, text: str, kind: str) -> str:
+        return hashlib.sha256(f"{self.model}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _lookup(self, texts: List[str], kind: str):
+        keys = [self.key(text, kind) for text in texts]
+        cached = self.store.get_many(list(dict.fromkeys(keys)))
+        missing = list(dict.fromkeys(text for text, key in zip(texts, keys) if key not in cached))
+        self.hits += len(texts) - sum(1 for key in keys if key not in cached)
+        self.misses += len(missing)
+        return keys, cached, missing
+
+    def _merge(self, texts: List[str], kind: str, keys: List[str], cached: Dict[str, np.ndarray], missing: List[str], computed) -> List[List[float]]:
+        fresh = {self.key(text, kind): np.asarray(vector, dtype=np.float32) for text, vector in zip(missing, computed)}
+        self.store.put_many(fresh)
+        cached.update(fresh)
+        return [cached[key].tolist() for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._lookup(texts, "document")
+        computed = self.inner.embed_documents(missing) if missing else []
+        return self._merge(texts, "document", keys, cached, missing, computed)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        # The store's SQLite and memmap I/O can wait on other processes, so it stays off the event loop
+        keys, cached, missing = await asyncio.to_thread(self._lookup, texts, "document")
+        computed = await self.inner.aembed_documents(missing) if missing else []
+        return await asyncio.to_thread(self._merge, texts, "document", keys, cached, missing, computed)
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, cached, missing = self._lookup([text], "query")
+        computed = [self.inner.embed_query(text)] if missing else []
+        return self._merge([text], "query", keys, cached, missing, computed)[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, cached, missing = await asyncio.to_thread(self._lookup, [text], "query")
+        computed = [await self.inner.aembed_query(text)] if missing else []
+        return (await asyncio.to_thread(self._merge, [text], "query", keys, cached, missing, computed))[0]
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Query vectors for several searches, with one cache lookup; models embed queries and documents differently."""
+        keys, cached, missing = await asyncio.to_thread(self._lookup, texts, "query")
+        computed = await asyncio.gather(*(self.inner.aembed_query(text) for text in missing))
+        return await asyncio.to_thread(self._merge, texts, "query", keys, cached, missing, computed)
+
+
+cached_embeddings = CachedEmbeddings()
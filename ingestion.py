@@ -0,0 +1,213 @@
+import asyncio
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from embedding_cache import cached_embeddings
+from vector_store import namespace_key, vector_stores
+
+logger = getLogger("ingestion")
+logger.setLevel(logging.DEBUG)
+
+PARSE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+QUEUE_SIZE = 8
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 150
+EMBED_BATCH_SIZE = 64
+UPSERT_BATCH_SIZE = 256
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+def parse_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    return _pool
+
+
+def parse_file(name: str, data: bytes) -> str:
+    """Extracts the text of an uploaded file. Runs in a worker process."""
+    extension = os.path.splitext(name)[1].lower()
+    if extension == ".pdf":
+        from pypdf import PdfReader
+
+        return "\n".join(page.extract_text() or "" for page in PdfReader(io.BytesIO(data)).pages)
+    if extension in IMAGE_EXTENSIONS:
+        import pytesseract
+        from PIL import Image
+
+        return pytesseract.image_to_string(Image.open(io.BytesIO(data)))
+    return data.decode("utf-8", errors="ignore")
+
+
+def supports_embeddings(store) -> bool:
+    return hasattr(store, "add_embeddings") or hasattr(store, "_collection")
+
+
+async def upsert(store, texts: List[str], vectors: Optional[List[List[float]]], metadatas: List[dict]):
+    if vectors is None:
+        await store.aadd_texts(texts, metadatas=metadatas)
+    elif hasattr(store, "add_embeddings"):
+        await asyncio.to_thread(store.add_embeddings, list(zip(texts, vectors)), metadatas=metadatas)
+    else:
+        # Chroma: write the precomputed vectors straight into the collection
+        ids = [f"{metadata['namespace']}/{metadata['source']}-{metadata['chunk']}" if "namespace" in metadata else f"{metadata['source']}-{metadata['chunk']}" for metadata in metadatas]
+        await asyncio.to_thread(store._collection.upsert, ids=ids, embeddings=vectors, documents=texts, metadatas=metadatas)
+
+
+class IngestionPipeline:
+    """Parse -> chunk -> embed -> upsert, each stage a task connected to the next by a bounded queue.
+
+    Parsing (and OCR) runs on a process pool, embeddings are requested in batches that span files, and
+    chunks are written to the vector store in bulk. on_progress receives the report of a file every time
+    it changes. Chunks go to the index of `namespace` and are tagged with it.
+    """
+
+    def __init__(self, store=None, on_progress: Optional[Callable[[Dict[str, Any]], None]] = None, namespace: Optional[str] = None):
+        self.store = store
+        self.on_progress = on_progress
+        self.namespace = namespace
+        self.reports: Dict[str, Dict[str, Any]] = {}
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+    def _update(self, name: str, **changes):
+        report = self.reports[name]
+        for key, value in changes.items():
+            if key in report["timings"]:
+                report["timings"][key] = round(report["timings"][key] + value, 3)
+            else:
+                report[key] = value
+        if self.on_progress is not None:
+            self.on_progress(dict(report, timings=dict(report["timings"])))
+
+    def _fail(self, name: str, error: Exception):
+        logger.error("Ingesting %s failed: %s", name, error)
+        self._update(name, status="failed", error=str(error))
+
+    async def run(self, files: List[Tuple[str, bytes]]) -> List[Dict[str, Any]]:
+        store = self.store or vector_stores.get_store(self.namespace)
+        tag = {"namespace": namespace_key(self.namespace)} if self.namespace else {}
+        precompute = supports_embeddings(store)
+        for name, _ in files:
+            self.reports[name] = {
+                "name": name, "status": "queued", "chunks": 0, "stored": 0, "error": None,
+                "timings": {"parse": 0.0, "chunk": 0.0, "embed": 0.0, "upsert": 0.0},
+            }
+
+        parsed: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        chunked: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        embedded: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        loop = asyncio.get_running_loop()
+
+        async def parse_one(name: str, data: bytes):
+            self._update(name, status="parsing")
+            started = time.perf_counter()
+            try:
+                text = await loop.run_in_executor(parse_pool(), parse_file, name, data)
+            except Exception as e:
+                self._fail(name, e)
+                return
+            self._update(name, status="parsed", parse=time.perf_counter() - started)
+            await parsed.put((name, text))
+
+        async def parse_stage():
+            await asyncio.gather(*(parse_one(name, data) for name, data in files))
+            await parsed.put(None)
+
+        async def chunk_stage():
+            while (item := await parsed.get()) is not None:
+                name, text = item
+                started = time.perf_counter()
+                chunks = self.splitter.split_text(text)
+                self._update(name, status="chunked" if chunks else "done", chunks=len(chunks), chunk=time.perf_counter() - started)
+                for index, chunk in enumerate(chunks):
+                    await chunked.put((chunk, {"source": name, "chunk": index, **tag}))
+            await chunked.put(None)
+
+        async def embed_batch(batch: List[Tuple[str, dict]]):
+            texts = [text for text, _ in batch]
+            vectors = None
+            if precompute:
+                started = time.perf_counter()
+                try:
+                    vectors = await cached_embeddings.aembed_documents(texts)
+                except Exception as e:
+                    for name in {metadata["source"] for _, metadata in batch}:
+                        self._fail(name, e)
+                    return
+                self._charge(batch, "embed", time.perf_counter() - started)
+            await embedded.put((batch, vectors))
+
+        async def embed_stage():
+            batch = []
+            while (item := await chunked.get()) is not None:
+                batch.append(item)
+                if len(batch) >= EMBED_BATCH_SIZE:
+                    await embed_batch(batch)
+                    batch = []
+            if batch:
+                await embed_batch(batch)
+            await embedded.put(None)
+
+        async def write(texts, vectors, metadatas):
+            started = time.perf_counter()
+            try:
+                await upsert(store, texts, vectors, metadatas)
+            except Exception as e:
+                for name in {metadata["source"] for metadata in metadatas}:
+                    self._fail(name, e)
+                return
+            self._charge(list(zip(texts, metadatas)), "upsert", time.perf_counter() - started)
+            for name in {metadata["source"] for metadata in metadatas}:
+                report = self.reports[name]
+                stored = report["stored"] + sum(1 for metadata in metadatas if metadata["source"] == name)
+                if report["status"] != "failed":
+                    self._update(name, stored=stored, status="done" if stored >= report["chunks"] else "storing")
+
+        async def upsert_stage():
+            texts, vectors, metadatas = [], [], []
+            while (item := await embedded.get()) is not None:
+                batch, batch_vectors = item
+                texts += [text for text, _ in batch]
+                metadatas += [metadata for _, metadata in batch]
+                vectors += batch_vectors or []
+                if len(texts) >= UPSERT_BATCH_SIZE:
+                    await write(texts, vectors if precompute else None, metadatas)
+                    texts, vectors, metadatas = [], [], []
+            if texts:
+                await write(texts, vectors if precompute else None, metadatas)
+
+        stages = [asyncio.ensure_future(stage()) for stage in (parse_stage, chunk_stage, embed_stage, upsert_stage)]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            # A failed stage stops draining its queue, so the others would block on it forever
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+        if any(report["stored"] for report in self.reports.values()):
+            vector_stores.invalidate(self.namespace)
+        return list(self.reports.values())
+
+    def _charge(self, batch: List[Tuple[str, dict]], stage: str, seconds: float):
+        # A batch mixes files, so its time is split between them by chunk count
+        counts: Dict[str, int] = {}
+        for _, metadata in batch:
+            counts[metadata["source"]] = counts.get(metadata["source"], 0) + 1
+        for name, count in counts.items():
+            self._update(name, **{stage: seconds * count / len(batch)})
+
+
+async def ingest_files(files: List[Tuple[str, bytes]], on_progress: Optional[Callable[[Dict[str, Any]], None]] = None, namespace: Optional[str] = None) -> List[Dict[str, Any]]:
+    return await IngestionPipeline(on_progress=on_progress, namespace=namespace).run(files)
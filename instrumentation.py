@@ -0,0 +1,212 @@
+import functools
+import inspect
+import json
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
+from uuid import UUID
+
+import logging
+from logging import getLogger
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.runnables import Runnable
+from langgraph.graph import StateGraph
+
+logger = getLogger("instrumentation")
+logger.setLevel(logging.DEBUG)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value: str) -> str:
+    # Label values in the text exposition format escape backslash, double quote and newline
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        with self._lock:
+            counts = self.series.setdefault(labels, [0] * len(self.buckets) + [0, 0.0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {labels: list(counts) for labels, counts in self.series.items()}
+        for labels, counts in series.items():
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (repr(float(bound)),))} {count}"
+            yield f"{self.name}_bucket{_labels(self.labels + ('le',), labels + ('+Inf',))} {counts[-2]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {counts[-2]}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {counts[-1]}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.series: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1):
+        with self._lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            series = dict(self.series)
+        for labels, value in series.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, labels, buckets))
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics.values() for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+
+node_seconds = metrics.histogram("agent_node_seconds", "Wall time of a graph node", ("graph", "node"))
+node_update_bytes = metrics.histogram("agent_node_update_bytes", "Size of the state update a node returns", ("graph", "node"), SIZE_BUCKETS)
+node_errors = metrics.counter("agent_node_errors_total", "Graph node invocations that raised", ("graph", "node"))
+llm_seconds = metrics.histogram("llm_request_seconds", "Latency of an LLM call", ("node", "model"))
+llm_prompt_bytes = metrics.histogram("llm_prompt_bytes", "Characters sent to the LLM per call", ("node",), SIZE_BUCKETS)
+llm_prompt_tokens = metrics.counter("llm_prompt_tokens_total", "Prompt tokens reported by the provider", ("node", "model"))
+llm_completion_tokens = metrics.counter("llm_completion_tokens_total", "Completion tokens reported by the provider", ("node", "model"))
+llm_retries = metrics.counter("llm_retries_total", "Retried LLM calls", ("node",))
+llm_errors = metrics.counter("llm_errors_total", "Failed LLM calls", ("node",))
+
+
+def current_node() -> str:
+    """Name of the graph node the caller runs in, or "" outside a graph run."""
+    try:
+        from langgraph.config import get_config
+
+        return get_config().get("metadata", {}).get("langgraph_node", "")
+    except RuntimeError:
+        return ""
+
+
+def payload_size(update: Any) -> int:
+    try:
+        return len(json.dumps(update, default=lambda o: o.model_dump() if hasattr(o, "model_dump") else str(o)))
+    except (TypeError, ValueError):
+        return 0
+
+
+def instrument_node(graph: str, name: str, fn):
+    """Wraps an async graph node with timing, update-size and error metrics."""
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            update = await fn(*args, **kwargs)
+        except Exception:
+            node_errors.inc(graph, name)
+            raise
+        elapsed = time.perf_counter() - started
+        node_seconds.observe(elapsed, graph, name)
+        size = payload_size(update) if isinstance(update, dict) else 0
+        node_update_bytes.observe(size, graph, name)
+        logger.debug("node graph=%s node=%s ms=%.1f update_bytes=%d", graph, name, elapsed * 1000, size)
+        return update
+
+    return wrapper
+
+
+class InstrumentedStateGraph(StateGraph):
+    """StateGraph whose async function nodes are wrapped with instrument_node."""
+
+    def __init__(self, *args, graph_name: str = "graph", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.graph_name = graph_name
+
+    def add_node(self, node, action=None, **kwargs):
+        if isinstance(node, str) and action is not None and not isinstance(action, Runnable) and inspect.iscoroutinefunction(action):
+            action = instrument_node(self.graph_name, node, action)
+        return super().add_node(node, action, **kwargs)
+
+
+class LLMMetricsHandler(BaseCallbackHandler):
+    """Callback handler recording latency, token usage, prompt size, retries and errors of every LLM call."""
+
+    def __init__(self):
+        self.runs: Dict[UUID, Tuple[float, str, str]] = {}
+
+    def _start(self, run_id: UUID, serialized: Optional[dict], metadata: Optional[dict], size: int):
+        node = (metadata or {}).get("langgraph_node", "")
+        model = (metadata or {}).get("ls_model_name", "") or ((serialized or {}).get("kwargs", {}) or {}).get("model_name", "")
+        self.runs[run_id] = (time.perf_counter(), node, model)
+        llm_prompt_bytes.observe(size, node)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        self._start(run_id, serialized, metadata, sum(len(str(message.content)) for batch in messages for message in batch))
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs):
+        self._start(run_id, serialized, metadata, sum(len(prompt) for prompt in prompts))
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs):
+        started, node, model = self.runs.pop(run_id, (None, "", ""))
+        if started is not None:
+            elapsed = time.perf_counter() - started
+            llm_seconds.observe(elapsed, node, model)
+        else:
+            elapsed = 0.0
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        if not usage:
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                    prompt_tokens += metadata.get("input_tokens", 0)
+                    completion_tokens += metadata.get("output_tokens", 0)
+        llm_prompt_tokens.inc(node, model, amount=prompt_tokens)
+        llm_completion_tokens.inc(node, model, amount=completion_tokens)
+        logger.debug("llm node=%s model=%s ms=%.1f prompt_tokens=%d completion_tokens=%d", node, model, elapsed * 1000, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs):
+        _, node, _ = self.runs.pop(run_id, (None, "", ""))
+        llm_errors.inc(node)
+        logger.warning("llm node=%s error=%s", node, error)
+
+    def on_retry(self, retry_state, *, run_id: UUID, **kwargs):
+        _, node, _ = self.runs.get(run_id, (None, "", ""))
+        llm_retries.inc(node)
+
+
+llm_metrics = LLMMetricsHandler()
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import logging
+from logging import getLogger
+
+from instrumentation import metrics
+
+logger = getLogger("intent_classifier")
+logger.setLevel(logging.DEBUG)
+
+ROLE_MODIFICATION = "RoleModification"
+TOOL_MODIFICATION = "ToolModification"
+LABELS = (ROLE_MODIFICATION, TOOL_MODIFICATION)
+
+CONFIDENCE_THRESHOLD = 0.75
+SHADOW_SAMPLE_RATE = 0.05
+TRAFFIC_LOG_PATH = "intent_examples.jsonl"
+NEIGHBOURS = 5
+# Similarity of the nearest labelled example at which the neighbours fully back a prediction
+SUPPORT_SIMILARITY = 0.6
+MAX_LEARNED_EXAMPLES = 2000
+
+KEYWORDS = {
+    TOOL_MODIFICATION: {
+        "add", "integrate", "integration", "connect", "tool", "tools", "api", "plugin", "access", "token",
+        "credentials", "gmail", "outlook", "email", "mail", "github", "repo", "repository", "drive", "dropbox",
+        "slack", "calendar", "jira", "notion", "sheets", "crm", "webhook", "fetch", "upload", "send",
+    },
+    ROLE_MODIFICATION: {
+        "should", "must", "behave", "behaviour", "behavior", "role", "prioritize", "prioritise", "priority",
+        "reject", "approve", "decide", "respond", "tone", "polite", "always", "never", "only", "escalate",
+        "policy", "rules", "rule", "instead", "act", "focus", "ignore",
+    },
+}
+
+# Hit rate is local / (local + fallback), accuracy shadow_agreed / shadow_checked
+intent_decisions = metrics.counter("intent_classifier_decisions_total", "Intent classifications by outcome: local, fallback, shadow_checked, shadow_agreed", ("outcome",))
+
+_EXAMPLE_PATTERN = re.compile(r'User Query:\s*"(.+?)"\s*\n\s*Intent:\s*(\w+)')
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+
+class LocalIntentClassifier:
+    """Keyword rules plus TF-IDF nearest neighbours over labelled queries.
+
+    Examples come from the few-shot block of INTENT_CLASSIFIER_PROMPT and from LLM-labelled traffic,
+    which is appended to a JSONL log and picked up again on restart. Distinct traffic queries are
+    kept up to max_learned, oldest dropped first.
+
+    Keywords alone never make a prediction confident: it also needs the nearest examples to agree,
+    with confidence scaled down when the closest of them is less similar than SUPPORT_SIMILARITY.
+    """
+
+    def __init__(self, examples: List[Tuple[str, str]], threshold: float = CONFIDENCE_THRESHOLD, log_path: Optional[str] = TRAFFIC_LOG_PATH, shadow_sample_rate: float = SHADOW_SAMPLE_RATE, max_learned: int = MAX_LEARNED_EXAMPLES):
+        self.threshold = threshold
+        self.log_path = log_path
+        self.shadow_sample_rate = shadow_sample_rate
+        self.max_learned = max_learned
+        self.examples: List[Tuple[Counter, str]] = []
+        self.document_frequency: Counter = Counter()
+        self._example_vectors: Optional[List[Tuple[Dict[str, float], str]]] = None
+        self.counters: Dict[str, int] = {"local": 0, "fallback": 0, "shadow_checked": 0, "shadow_agreed": 0}
+        # Shadow checks run in the background; holding them keeps them from being garbage-collected mid-call
+        self._shadow_tasks: Set[asyncio.Task] = set()
+        self.seen: Set[str] = set()
+        # Learned (query, label) pairs, oldest first; they follow the seed examples in self.examples
+        self.learned: List[Tuple[str, str]] = []
+        self._logged_lines = 0
+        self._log_lock = threading.Lock()
+        for query, label in examples:
+            self._remember(query, label)
+        self.seeds = len(self.examples)
+        logged = self._load_log()
+        for query, label in logged:
+            self._remember(query, label, learned=True)
+        self._trim()
+        if len(logged) > len(self.learned):
+            self._rewrite_log()
+
+    @classmethod
+    def from_prompt(cls, prompt: str, **kwargs) -> "LocalIntentClassifier":
+        examples = [(query, label) for query, label in _EXAMPLE_PATTERN.findall(prompt) if label in LABELS]
+        return cls(examples, **kwargs)
+
+    def _load_log(self) -> List[Tuple[str, str]]:
+        if not self.log_path or not os.path.exists(self.log_path):
+            return []
+        examples = []
+        with open(self.log_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("label") in LABELS:
+                    examples.append((record["query"], record["label"]))
+        return examples
+
+    def _remember(self, query: str, label: str, learned: bool = False) -> bool:
+        terms = Counter(tokenize(query))
+        key = " ".join(tokenize(query))
+        if not terms or key in self.seen:
+            return False
+        self.seen.add(key)
+        self.examples.append((terms, label))
+        self.document_frequency.update(terms.keys())
+        self._example_vectors = None
+        if learned:
+            self.learned.append((query, label))
+        return True
+
+    def _trim(self):
+        while len(self.learned) > self.max_learned:
+            query, _ = self.learned.pop(0)
+            terms, _ = self.examples.pop(self.seeds)
+            self.document_frequency.subtract(terms.keys())
+            self.seen.discard(" ".join(tokenize(query)))
+            self._example_vectors = None
+
+    def _rewrite_log(self):
+        # Compacts the log to the examples still in use
+        with self._log_lock:
+            with open(self.log_path + ".tmp", "w", encoding="utf-8") as f:
+                f.writelines(json.dumps({"query": query, "label": label}) + "\n" for query, label in list(self.learned))
+            os.replace(self.log_path + ".tmp", self.log_path)
+            self._logged_lines = len(self.learned)
+
+    def _append_log(self, query: str, label: str):
+        with self._log_lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"query": query, "label": label}) + "\n")
+            self._logged_lines += 1
+            compact = self._logged_lines > 2 * self.max_learned
+        if compact:
+            self._rewrite_log()
+
+    def _vector(self, terms: Counter) -> Dict[str, float]:
+        total = len(self.examples) + 1
+        vector = {term: count * math.log(total / (1 + self.document_frequency.get(term, 0))) for term, count in terms.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {term: weight / norm for term, weight in vector.items()}
+
+    def predict(self, query: str) -> Tuple[str, float]:
+        terms = Counter(tokenize(query))
+        scores = {label: 0.0 for label in LABELS}
+        neighbours = {label: 0.0 for label in LABELS}
+        nearest = {label: 0.0 for label in LABELS}
+
+        for label, keywords in KEYWORDS.items():
+            scores[label] += sum(count for term, count in terms.items() if term in keywords)
+
+        if self.examples and terms:
+            if self._example_vectors is None:
+                self._example_vectors = [(self._vector(example_terms), label) for example_terms, label in self.examples]
+            query_vector = self._vector(terms)
+            similarities = []
+            for example_vector, label in self._example_vectors:
+                similarity = sum(weight * example_vector.get(term, 0.0) for term, weight in query_vector.items())
+                similarities.append((similarity, label))
+            similarities.sort(reverse=True)
+            for similarity, label in similarities[:NEIGHBOURS]:
+                scores[label] += 2 * similarity
+                neighbours[label] += similarity
+                nearest[label] = max(nearest[label], similarity)
+
+        total = sum(scores.values())
+        if total == 0:
+            return TOOL_MODIFICATION, 0.0
+        label = max(scores, key=scores.get)
+        if neighbours[label] <= max(value for other, value in neighbours.items() if other != label):
+            # Keyword hits the labelled examples do not back up are left to the LLM
+            return label, 0.0
+        support = min(1.0, nearest[label] / SUPPORT_SIMILARITY)
+        return label, scores[label] / total * support
+
+    async def learn(self, query: str, label: str):
+        if label not in LABELS or not self._remember(query, label, learned=True):
+            return
+        self._trim()
+        if self.log_path:
+            await asyncio.to_thread(self._append_log, query, label)
+
+    async def classify(self, query: str, fallback: Callable[[], Awaitable[str]]) -> str:
+        label, confidence = self.predict(query)
+        if confidence >= self.threshold:
+            self._count("local")
+            logger.debug("Local intent %s (%.2f) for %r", label, confidence, query)
+            if random.random() < self.shadow_sample_rate:
+                task = asyncio.create_task(self._shadow_check(query, label, fallback))
+                self._shadow_tasks.add(task)
+                task.add_done_callback(self._shadow_tasks.discard)
+            return label
+
+        self._count("fallback")
+        label = (await fallback()).strip()
+        await self.learn(query, label)
+        return label
+
+    async def _shadow_check(self, query: str, local_label: str, fallback: Callable[[], Awaitable[str]]):
+        # Compare a sample of local answers with the LLM so accuracy can be tracked in production
+        try:
+            llm_label = (await fallback()).strip()
+        except Exception as e:
+            logger.warning("Shadow intent check failed: %s", e)
+            return
+        self._count("shadow_checked")
+        if llm_label == local_label:
+            self._count("shadow_agreed")
+
+    def _count(self, outcome: str):
+        self.counters[outcome] += 1
+        intent_decisions.inc(outcome)
+
+    def stats(self) -> Dict[str, float]:
+        classified = self.counters["local"] + self.counters["fallback"]
+        checked = self.counters["shadow_checked"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["local"] / classified if classified else 0.0,
+            "accuracy": self.counters["shadow_agreed"] / checked if checked else 0.0,
+        }
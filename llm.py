@@ -1,11 +1,32 @@
-from langchain_openai import ChatOpenAI
 from config import OPENAI_API_KEY
 from langchain_core.messages import HumanMessage, AIMessage
-llm = ChatOpenAI(
-    model="gpt-4o-mini",
-    temperature=0.7,
-    api_key=OPENAI_API_KEY  
-)
+from instrumentation import llm_metrics
+from llm_gateway import LLMGateway, LLM_TIMEOUT_SECONDS, http_clients
+
+def build_llm():
+    # langchain_openai and the OpenAI SDK are slow to import, so the model is built on first use or during warm-up
+    from langchain_openai import ChatOpenAI
+
+    http_client, http_async_client = http_clients()
+    return ChatOpenAI(
+        model="gpt-4o-mini",
+        temperature=0.7,
+        api_key=OPENAI_API_KEY,
+        callbacks=[llm_metrics],
+        # Retries and backoff are done by the gateway, over its pooled connections
+        max_retries=0,
+        timeout=LLM_TIMEOUT_SECONDS,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+
+gateway = LLMGateway(factory=build_llm)
+
+def __getattr__(name):
+    # `from llm import llm` still works and builds the model
+    if name == "llm":
+        return gateway.llm
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
-    print(llm.invoke([HumanMessage(content="What tools do I need to complete my task?")]))
\ No newline at end of file
+    print(gateway.llm.invoke([HumanMessage(content="What tools do I need to complete my task?")]))
\ No newline at end of file
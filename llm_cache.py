@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+import numpy as np
+from langchain_core.messages import AIMessage
+
+logger = getLogger("llm_cache")
+logger.setLevel(logging.DEBUG)
+
+CACHE_DB_PATH = "llm_cache.sqlite"
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_MAX_MEMORY_ENTRIES = 2048
+CACHE_MAX_DISK_ENTRIES = 50_000
+SEMANTIC_THRESHOLD = 0.97
+CACHE_TRIM_EVERY = 100
+CACHE_TOUCH_BATCH = 64
+
+# Near-deterministic calls whose answers are worth reusing; every other node always goes to the LLM
+CACHED_NODES = {"intent_classifier", "verify_information", "user_confirmation", "check_requirements_node"}
+
+
+def render_prompt(messages) -> str:
+    if isinstance(messages, str):
+        return messages
+    return "\n".join(f"{message.type}: {message.content}" for message in messages)
+
+
+def _dump(result) -> str:
+    if isinstance(result, AIMessage):
+        return json.dumps({"type": "message", "content": result.content})
+    if hasattr(result, "model_dump"):
+        return json.dumps({"type": "model", "data": result.model_dump()})
+    return json.dumps({"type": "json", "data": result})
+
+
+def _load(payload: str, schema=None):
+    payload = json.loads(payload)
+    if payload["type"] == "message":
+        return AIMessage(content=payload["content"])
+    if payload["type"] == "model" and schema is not None:
+        return schema(**payload["data"])
+    return payload["data"]
+
+
+class LLMCache:
+    """Two-tier cache for LLM calls, keyed on (model, node, schema, rendered prompt).
+
+    The exact tier is an in-memory LRU backed by SQLite, both with a TTL. The optional semantic tier
+    embeds the prompt and reuses the closest cached answer for the same node above a cosine threshold.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_DB_PATH,
+        nodes: Iterable[str] = CACHED_NODES,
+        ttl_seconds: float = CACHE_TTL_SECONDS,
+        max_memory_entries: int = CACHE_MAX_MEMORY_ENTRIES,
+        max_disk_entries: int = CACHE_MAX_DISK_ENTRIES,
+        embeddings=None,
+        semantic_nodes: Iterable[str] = (),
+        semantic_threshold: float = SEMANTIC_THRESHOLD,
+    ):
+        self.path = path
+        self.nodes = set(nodes)
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.embeddings = embeddings
+        self.semantic_nodes = set(semantic_nodes)
+        self.semantic_threshold = semantic_threshold
+        self.memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._conn = None
+        # key -> time of hits not yet written to last_used
+        self._touched: Dict[str, float] = {}
+        self._puts = 0
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, node TEXT, payload TEXT, expires REAL, last_used REAL, embedding BLOB)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_node ON llm_cache (node)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+        return self._conn
+
+    def key(self, model: str, node: str, prompt: str, schema=None) -> str:
+        schema_name = getattr(schema, "__name__", "")
+        return hashlib.sha256(f"{model}\0{node}\0{schema_name}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Blocking lookup in memory, then on disk; async callers use aget."""
+        payload = self._get_memory(key)
+        return payload if payload is not None else self._get_disk(key)
+
+    async def aget(self, key: str) -> Optional[str]:
+        payload = self._get_memory(key)
+        if payload is None:
+            payload = await asyncio.to_thread(self._get_disk, key)
+        return payload
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self.memory[key]
+                return None
+            self.memory.move_to_end(key)
+            self._touched[key] = now
+            return entry[1]
+
+    def _get_disk(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._db_lock:
+            row = self.conn.execute("SELECT payload, expires FROM llm_cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        with self._lock:
+            self._remember(key, row[1], row[0])
+            self._touched[key] = now
+            flush = len(self._touched) >= CACHE_TOUCH_BATCH
+        if flush:
+            self._flush_touched()
+        return row[0]
+
+    def _flush_touched(self):
+        # Hits only note their time; last_used is written for a batch of them at once
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with self._db_lock:
+                self.conn.executemany("UPDATE llm_cache SET last_used = ? WHERE key = ?", [(used, key) for key, used in touched.items()])
+                self.conn.commit()
+
+    def put(self, key: str, node: str, payload: str, embedding: Optional[np.ndarray] = None):
+        """Blocking store; async callers use aput."""
+        self._write(*self._entry(key, node, payload, embedding))
+
+    async def aput(self, key: str, node: str, payload: str, embedding: Optional[np.ndarray] = None):
+        await asyncio.to_thread(self._write, *self._entry(key, node, payload, embedding))
+
+    def _entry(self, key: str, node: str, payload: str, embedding: Optional[np.ndarray]) -> tuple:
+        now = time.time()
+        expires = now + self.ttl_seconds
+        with self._lock:
+            self._remember(key, expires, payload)
+        blob = embedding.astype(np.float32).tobytes() if embedding is not None else None
+        return key, node, payload, expires, now, blob
+
+    def _write(self, key: str, node: str, payload: str, expires: float, now: float, blob: Optional[bytes]):
+        self._flush_touched()
+        with self._db_lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, node, payload, expires, last_used, embedding) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, node, payload, expires, now, blob),
+            )
+            self._puts += 1
+            if self._puts % CACHE_TRIM_EVERY == 0:
+                self._trim(now)
+            self.conn.commit()
+
+    def _trim(self, now: float):
+        # Every CACHE_TRIM_EVERY puts rather than on each one; the table may overshoot by that many rows
+        self.conn.execute("DELETE FROM llm_cache WHERE expires <= ?", (now,))
+        excess = self.conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_disk_entries
+        if excess > 0:
+            self.conn.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used LIMIT ?)", (excess,))
+
+    def _remember(self, key: str, expires: float, payload: str):
+        self.memory[key] = (expires, payload)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def nearest(self, node: str, embedding: np.ndarray) -> Optional[str]:
+        with self._db_lock:
+            rows = self.conn.execute(
+                "SELECT key, embedding FROM llm_cache WHERE node = ? AND embedding IS NOT NULL AND expires > ?",
+                (node, time.time()),
+            ).fetchall()
+        if not rows:
+            return None
+        matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+        scores = matrix @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.semantic_threshold:
+            return None
+        return self.get(rows[best][0])
+
+    async def _embed(self, prompt: str) -> np.ndarray:
+        vector = np.asarray(await self.embeddings.aembed_query(prompt), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    async def ainvoke(self, runnable, messages, node: str, schema=None, model: Optional[str] = None):
+        if node not in self.nodes:
+            return await runnable.ainvoke(messages)
+
+        prompt = render_prompt(messages)
+        key = self.key(model or "", node, prompt, schema)
+        payload = await self.aget(key)
+
+        embedding = None
+        if payload is None and self.embeddings is not None and node in self.semantic_nodes:
+            embedding = await self._embed(prompt)
+            payload = await asyncio.to_thread(self.nearest, node, embedding)
+
+        if payload is not None:
+            self.hits[node] = self.hits.get(node, 0) + 1
+            logger.debug("Cache hit for %s", node)
+            return _load(payload, schema)
+
+        self.misses[node] = self.misses.get(node, 0) + 1
+        result = await runnable.ainvoke(messages)
+        await self.aput(key, node, _dump(result), embedding)
+        return result
+
+
+response_cache = LLMCache()
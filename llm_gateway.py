@@ -0,0 +1,247 @@
+import asyncio
+import os
+import random
+import time
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Callable, Dict, Optional
+
+import logging
+from logging import getLogger
+
+from instrumentation import current_node, llm_retries, metrics
+from llm_cache import response_cache
+
+logger = getLogger("llm_gateway")
+logger.setLevel(logging.DEBUG)
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_TENANT_CONCURRENCY = int(os.getenv("LLM_TENANT_CONCURRENCY", "4"))
+LLM_RATE_PER_SECOND = float(os.getenv("LLM_RATE_PER_SECOND", "10"))
+LLM_BURST = int(os.getenv("LLM_BURST", "20"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+WARM_CONNECTIONS = 4
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20.0
+DEFAULT_TENANT = "default"
+
+
+@lru_cache(maxsize=1)
+def http_clients():
+    """The sync and async httpx clients behind every LLM request of the process: one keep-alive pool."""
+    import httpx
+
+    limits = httpx.Limits(max_connections=LLM_MAX_CONCURRENCY, max_keepalive_connections=LLM_MAX_CONCURRENCY, keepalive_expiry=60)
+    timeout = httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=10)
+    return httpx.Client(limits=limits, timeout=timeout), httpx.AsyncClient(limits=limits, timeout=timeout)
+
+current_tenant: ContextVar[str] = ContextVar("llm_tenant", default=DEFAULT_TENANT)
+
+# Not labelled by tenant: without X-Tenant-ID every session is a tenant, which would be a series per session
+llm_queue_seconds = metrics.histogram("llm_queue_seconds", "Time an LLM call waited for a rate-limit token and a concurrency slot")
+
+
+@contextmanager
+def tenant(name: Optional[str]):
+    """LLM calls made inside the block, including from tasks started in it, count against tenant `name`."""
+    token = current_tenant.set(name or DEFAULT_TENANT)
+    try:
+        yield
+    finally:
+        current_tenant.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+    def drain(self):
+        # After a 429 nobody should get the burst allowance until the bucket refills
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def retry_after(error: BaseException) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def retry_delay(error: BaseException, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying after `error`, or None when it is not worth retrying."""
+    # Only reached on errors, so the SDKs are already loaded
+    import httpx
+    import openai
+
+    status = status_code(error)
+    if status is None:
+        if not isinstance(error, (openai.APIConnectionError, httpx.TransportError, asyncio.TimeoutError)):
+            return None
+    elif status != 429 and status < 500:
+        return None
+    # Full jitter, so clients that failed together do not retry together
+    backoff = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    return max(backoff, retry_after(error))
+
+
+class _Limited:
+    # What LLMCache invokes on a miss: the runnable behind the gateway's limits
+    def __init__(self, gateway: "LLMGateway", runnable):
+        self.gateway = gateway
+        self.runnable = runnable
+
+    async def ainvoke(self, messages):
+        return await self.gateway.call(self.runnable, messages)
+
+
+class LLMGateway:
+    """Single way out to the LLM for every node.
+
+    Calls first take a token from a process-wide token bucket, then a slot of the caller's tenant
+    (see `tenant`) and a global slot. Connection errors, 429s and 5xxs are retried with jittered
+    exponential backoff, honouring Retry-After; a 429 also drains the bucket. Structured-output
+    runnables are built once per schema, and calls for nodes in the response cache are answered
+    from it without touching the limits.
+    """
+
+    def __init__(
+        self,
+        llm=None,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        tenant_concurrency: int = LLM_TENANT_CONCURRENCY,
+        rate_per_second: float = LLM_RATE_PER_SECOND,
+        burst: int = LLM_BURST,
+        max_retries: int = LLM_MAX_RETRIES,
+        cache=response_cache,
+        factory: Optional[Callable[[], Any]] = None,
+    ):
+        self._llm = llm
+        self.factory = factory
+        self.max_concurrency = max_concurrency
+        self.tenant_concurrency = tenant_concurrency
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.cache = cache
+        self._structured: Dict[Any, Any] = {}
+        self._loop = None
+
+    def _bind(self):
+        # asyncio primitives belong to one event loop; scripts that call asyncio.run repeatedly get fresh ones
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self.bucket = TokenBucket(self.rate_per_second, self.burst)
+            self.slots = asyncio.Semaphore(self.max_concurrency)
+            self.tenant_slots: Dict[str, asyncio.Semaphore] = {}
+            self.tenant_active: Dict[str, int] = {}
+
+    @property
+    def llm(self):
+        if self._llm is None and self.factory is not None:
+            self._llm = self.factory()
+        return self._llm
+
+    @llm.setter
+    def llm(self, llm):
+        self._llm = llm
+        self._structured = {}
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.llm, "model_name", "")
+
+    def structured(self, schema):
+        runnable = self._structured.get(schema)
+        if runnable is None:
+            runnable = self._structured[schema] = self.llm.with_structured_output(schema)
+        return runnable
+
+    @asynccontextmanager
+    async def _slot(self, tenant_id: str):
+        semaphore = self.tenant_slots.get(tenant_id)
+        if semaphore is None:
+            semaphore = self.tenant_slots[tenant_id] = asyncio.Semaphore(self.tenant_concurrency)
+        self.tenant_active[tenant_id] = self.tenant_active.get(tenant_id, 0) + 1
+        try:
+            async with semaphore, self.slots:
+                yield
+        finally:
+            self.tenant_active[tenant_id] -= 1
+            if not self.tenant_active[tenant_id]:
+                # Idle tenants are forgotten, so the table stays as large as the number of active ones
+                del self.tenant_active[tenant_id]
+                del self.tenant_slots[tenant_id]
+
+    async def call(self, runnable, messages):
+        self._bind()
+        tenant_id = current_tenant.get()
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            await self.bucket.acquire()
+            async with self._slot(tenant_id):
+                llm_queue_seconds.observe(time.perf_counter() - queued)
+                try:
+                    return await runnable.ainvoke(messages)
+                except Exception as e:
+                    delay = retry_delay(e, attempt) if attempt < self.max_retries else None
+                    if delay is None:
+                        raise
+                    error = e
+            # Backoff happens outside the slot, so waiting retries do not block other calls
+            if status_code(error) == 429:
+                self.bucket.drain()
+            llm_retries.inc(current_node())
+            logger.warning("LLM call failed (%s), retry %d in %.2fs", error, attempt + 1, delay)
+            await asyncio.sleep(delay)
+
+    async def ainvoke(self, messages, schema=None, cache_node: Optional[str] = None):
+        """Chat completion, or an instance of `schema` when one is given; cached when `cache_node` is."""
+        runnable = self.llm if schema is None else self.structured(schema)
+        if cache_node is not None:
+            return await self.cache.ainvoke(_Limited(self, runnable), messages, cache_node, schema, model=self.model_name)
+        return await self.call(runnable, messages)
+
+    async def warm_up(self, connections: int = WARM_CONNECTIONS):
+        """Opens `connections` pooled connections to the provider, so the first calls skip the TLS handshake."""
+        client = getattr(self.llm, "root_async_client", None)
+        if client is None:
+            return
+        await asyncio.gather(*(client.models.list() for _ in range(min(connections, self.max_concurrency))))
+
+    async def aclose(self):
+        if http_clients.cache_info().currsize:
+            http_client, http_async_client = http_clients()
+            await http_async_client.aclose()
+            http_client.close()
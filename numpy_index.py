@@ -0,0 +1,153 @@
+import json
+import os
+import threading
+from typing import Any, Iterable, List, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+logger = getLogger("numpy_index")
+logger.setLevel(logging.DEBUG)
+
+NUMPY_INDEX_DIR = "vector_index"
+GROWTH_ROWS = 1024
+
+
+class NumpyVectorStore(VectorStore):
+    """Embedded vector store: normalized float32 vectors in a memory-mapped matrix, searched with one matmul.
+
+    Files in `path`: vectors.f32 (rows x dim), documents.jsonl (one line per row) and meta.json, which
+    holds the committed row count and byte length of documents.jsonl. meta.json is replaced last on every
+    append, so readers never see partial rows and a crashed append is simply overwritten by the next one.
+    """
+
+    def __init__(self, embedding: Embeddings, path: str = NUMPY_INDEX_DIR):
+        self.embedding = embedding
+        self.path = path
+        self._lock = threading.Lock()
+        self.dim: Optional[int] = None
+        self.count = 0
+        self.offset = 0
+        self.documents: List[Document] = []
+        self.matrix: Optional[np.memmap] = None
+        os.makedirs(path, exist_ok=True)
+        self.load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory of the index once searched: the vector rows plus the document text."""
+        return self.count * 4 * (self.dim or 0) + self.offset
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _capacity(self) -> int:
+        if not self.dim or not os.path.exists(self._file("vectors.f32")):
+            return 0
+        return os.path.getsize(self._file("vectors.f32")) // (4 * self.dim)
+
+    def _map(self, rows: int):
+        if self._capacity() < rows:
+            with open(self._file("vectors.f32"), "ab") as f:
+                f.truncate(rows * 4 * self.dim)
+        self.matrix = np.memmap(self._file("vectors.f32"), dtype=np.float32, mode="r+", shape=(self._capacity(), self.dim)) if rows else None
+
+    def load(self):
+        try:
+            with open(self._file("meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        self.dim, self.count, self.offset = meta["dim"], meta["count"], meta["offset"]
+        with open(self._file("documents.jsonl"), "rb") as f:
+            lines = f.read(self.offset).decode("utf-8").splitlines()
+        self.documents = [Document(page_content=record["text"], metadata=record["metadata"]) for record in map(json.loads, lines)]
+        self._map(self.count)
+        logger.info("Loaded %d vectors from %s", self.count, self.path)
+
+    def add_embeddings(self, text_embeddings: Iterable[Tuple[str, List[float]]], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        if not text_embeddings:
+            return []
+        metadatas = metadatas or [{} for _ in text_embeddings]
+        vectors = np.asarray([vector for _, vector in text_embeddings], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+
+            start, end = self.count, self.count + len(vectors)
+            if self.matrix is None or len(self.matrix) < end:
+                self._map(max(end, 2 * self._capacity(), GROWTH_ROWS))
+            self.matrix[start:end] = vectors
+            self.matrix.flush()
+
+            lines = "".join(json.dumps({"text": text, "metadata": metadata}) + "\n" for (text, _), metadata in zip(text_embeddings, metadatas)).encode("utf-8")
+            with open(self._file("documents.jsonl"), "ab") as f:
+                f.truncate(self.offset)
+                f.write(lines)
+            meta_path = self._file("meta.json")
+            with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "count": end, "offset": self.offset + len(lines)}, f)
+            os.replace(meta_path + ".tmp", meta_path)
+            self.offset += len(lines)
+
+            self.documents.extend(Document(page_content=text, metadata=metadata) for (text, _), metadata in zip(text_embeddings, metadatas))
+            self.count = end
+        return ids or [str(index) for index in range(start, end)]
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self.embedding.embed_documents(texts)), metadatas=metadatas, **kwargs)
+
+    async def aadd_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, await self.embedding.aembed_documents(texts)), metadatas=metadatas, **kwargs)
+
+    def _top_k(self, embedding: List[float], k: int) -> List[Tuple[Document, float]]:
+        count = self.count
+        if not count or k <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        scores = self.matrix[:count] @ query
+        k = min(k, count)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.documents[index], float(scores[index])) for index in top]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self._top_k(embedding, k)]
+
+    async def asimilarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(embedding, k)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self._top_k(self.embedding.embed_query(query), k)
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score(query, k)
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k)]
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return self.similarity_search_by_vector(await self.embedding.aembed_query(query), k)
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, path: str = NUMPY_INDEX_DIR, **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding, path=path)
+        store.add_texts(texts, metadatas=metadatas)
+        return store
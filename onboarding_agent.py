@@ -1,17 +1,25 @@
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
-from langgraph.graph import StateGraph, END, START
+from langgraph.graph import END, START
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from prompts.prompt import *
 from pydantic import BaseModel, Field
 from typing import Optional, List, Annotated
-from llm import llm
+from llm import gateway
+from intent_classifier import LocalIntentClassifier, ROLE_MODIFICATION
+from tool_registry import tool_registry
+from transcript import transcript_for
+from token_budget import fit_history
+from prompt_encoding import encode_names, encode_tools, render
+from instrumentation import InstrumentedStateGraph
+from rolling_summary import UPDATE_SUMMARY_PROMPT, full_summary_history, needs_full_summary, tail_rewritten
 from langgraph.graph.message import add_messages
 from langgraph.types import interrupt, Command
 import logging
 from logging import getLogger
 
 import base64
+import os
 from io import BytesIO
 
 logger = getLogger("onboarding_agent")
@@ -21,6 +29,11 @@ formatter = logging.Formatter(
     fmt='[%(asctime)s] [%(name)s] [%(levelname)s] - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    handler.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    logger.addHandler(handler)
 
 def override(_, new):
     return new
@@ -48,16 +61,25 @@ class AgentState(BaseModel):
     response: str= ""
     intent: str = ""
     summary: str = ""
+    summary_upto: int = 0
+    summary_turns: int = 0
+    history_trims: int = 0 # times old messages were dropped from context_history to bound the state size
+    refresh_summary: bool = False
     available_tools: dict = {}
 
 
 
 class OnboardingAgent:
-    def __init__(self):
+    USER_FACING_NODES = ("GatherInformation", "CheckRequirements")
+
+    def __init__(self, checkpointer=None, defer_summary: bool = False):
+        self.checkpointer = checkpointer
+        self.defer_summary = defer_summary
+        self.intent_model = LocalIntentClassifier.from_prompt(INTENT_CLASSIFIER_PROMPT)
         self.graph = self.build_graph()
 
     def build_graph(self):
-        builder = StateGraph(AgentState)
+        builder = InstrumentedStateGraph(AgentState, graph_name="onboarding")
 
         builder.add_node("GatherInformation", self.gather_information)
         builder.add_node("VerifyInformation", self.verify_information)
@@ -76,7 +98,7 @@ class OnboardingAgent:
         builder.add_edge("CheckRequirements", "GenerateSummary")
         builder.add_edge("GenerateSummary", END)
 
-        return builder.compile()
+        return builder.compile(checkpointer=self.checkpointer)
     
     def route_start(self, state: AgentState) -> str:
 
@@ -98,167 +120,184 @@ class OnboardingAgent:
             logger.info("Fetching tools")
             return "GetTools"
         elif not state.get_tools_flag and state.has_enough_information:
-            print("Skipping tool fetch")
             logger.info("Skipping tool fetch")
             return "SuggestTool"
         elif not state.has_enough_information:
             logger.info("Not enough information, going back to gather information")
             return "GenerateSummary"
 
-    def intent_classifier(self, state: AgentState) -> Command:
-        print("Classifying intent")
+    async def intent_classifier(self, state: AgentState) -> Command:
+        logger.info("Classifying intent")
 
-        prompt = INTENT_CLASSIFIER_PROMPT.format(
-            query=state.query,
-            context_history="\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in state.context_history] if state.context_history else ""),
-            )
+        async def classify_with_llm() -> str:
+            prompt = INTENT_CLASSIFIER_PROMPT.format(
+                query=state.query,
+                context_history=fit_history("intent_classifier", transcript_for(state.context_history, state.history_trims), INTENT_CLASSIFIER_PROMPT, state.query),
+                )
 
-        messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
-        print(f"\n Response: {response.content}")
+            messages = [AIMessage(content=prompt)]
+            response = await gateway.ainvoke(messages, cache_node="intent_classifier")
+            logger.debug("Response: %s", response.content)
+            return response.content
 
-        if response.content == "RoleModification":
+        # Most queries are settled locally; the LLM is only asked when the local model is unsure
+        intent = await self.intent_model.classify(state.query, classify_with_llm)
+
+        if intent == ROLE_MODIFICATION:
             return Command(
-                goto = "GatherInformation")
+                goto = "GatherInformation", update={"intent": intent})
+        return {"intent": intent}
 
-    def gather_information(self, state: AgentState) -> AgentState:
+    async def gather_information(self, state: AgentState) -> AgentState:
         logger.info("Gathering information")
-        print("Gathering information")
 
         prompt=ASK_FOLLOWUP_QUESTION_PROMPT.format(
             query=state.query,
-            context_history="\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in state.context_history] if state.context_history else ""),
+            context_history=fit_history("gather_information", transcript_for(state.context_history, state.history_trims), ASK_FOLLOWUP_QUESTION_PROMPT, state.query),
         )
         messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
-        print(f"\n Response: {response}")
+        response = await gateway.ainvoke(messages)
+        logger.debug("Response: %s", response)
         response = response.content
 
         state.context_history.append({"role": "user", "content": state.query})
         state.context_history.append({"role": "assistant", "content": response})
 
-        print(f"\n Updated context history: {state.context_history}")
 
         return {"response": response, "context_history": state.context_history}
 
-    def verify_information(self,state: AgentState) -> AgentState:
-        print("Verifying information")
+    async def verify_information(self,state: AgentState) -> AgentState:
+        logger.info("Verifying information")
 
         prompt=VERIFY_INFORMATION_PROMPT.format(
-            context_history="\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in state.context_history] if state.context_history else ""),
+            context_history=fit_history("verify_information", transcript_for(state.context_history, state.history_trims), VERIFY_INFORMATION_PROMPT),
         )
 
         messages = [AIMessage(content=prompt)]
-        structured_llm = llm.with_structured_output(VerifyInformation)
-        response = structured_llm.invoke(messages)
-        print(f"\n Response: {response}")
+        response = await gateway.ainvoke(messages, VerifyInformation, cache_node="verify_information")
+        logger.debug("Response: %s", response)
         if response.satisfied:
             context_history = state.context_history[:-1]
         else:  # Exclude the last user message
             context_history = state.context_history
-        return {"has_enough_information": response.satisfied,"context_history": context_history}
+        return {"has_enough_information": response.satisfied,"context_history": context_history, **tail_rewritten(state.summary_upto, len(context_history))}
 
-    def get_tools_node(self,state: AgentState) -> AgentState:
+    def tool_query(self, state: AgentState) -> str:
+        return f"{state.query}\n{transcript_for(state.context_history, state.history_trims).last(4)}"
 
-        tools = {"list_repositories": "To list Github repos","create_repository" :"To create Github repo", "delete_repository" :"To delete github repo", "send_outlook_email" :"To send Outlook email","send_email":"To send mail on gmail","search_emails":"To send mail on gmail","delete_email":"Delete a mail on gmail","list_drive_files":"List files of the Google drive", "search_drive_files":"Search a file on google drive", "read_drive_file":"Read a file on google drive","delete_drive_file":"Delete a file on Google Drive"} # Simulated tool retrieval
-        print("Retrieving tools") #TODO
-        message={"role": "system", "content": f"You have access to the following tools: {tools}"}
-        context_history=state.context_history + [message]
+    async def get_tools_node(self,state: AgentState) -> AgentState:
+        logger.info("Retrieving tools")
+        tools = await tool_registry.search(self.tool_query(state), required=state.tools_selected)
         return {"get_tools_flag": False, "available_tools": tools}
 
-    def tools_needed_node(self,state: AgentState) -> AgentState:
-        print("Suggesting Tools")
+    async def tools_needed_node(self,state: AgentState) -> AgentState:
+        logger.info("Suggesting tools")
 
         context_history = state.context_history
         user_query = state.query
-        print(state.tools.tools_needed)
-        formatted_context_history = ""
-        if context_history:
-            for message in context_history:
-                role = message["role"].capitalize()
-                content = message["content"]
-                formatted_context_history += f"{role}: {content}\n"
+        logger.debug("Tools needed so far: %s", state.tools.tools_needed)
+        # Only the tools relevant to this turn go into the prompt, plus whatever is already chosen
+        available_tools = await tool_registry.search(
+            self.tool_query(state),
+            required=[*state.tools_selected, *state.tools.tools_needed, *state.tools.tools_suggested],
+        )
+        tools_text = encode_tools(available_tools)
+        formatted_context_history = fit_history("tools_needed_node", transcript_for(context_history, state.history_trims), QUERY_PROMPT, user_query, tools_text)
 
         context_history = context_history + [{"role": "user", "content": user_query}]
-        prompt= QUERY_PROMPT.format(
+        prompt= render(
+            "QUERY_PROMPT", QUERY_PROMPT,
+            raw={"tools": state.tools_selected, "available_tools": available_tools},
             query=user_query,
             context_history=formatted_context_history,
-            tools=state.tools_selected,
-            available_tools=state.available_tools
+            tools=encode_names(state.tools_selected),
+            available_tools=tools_text
         )
 
-        structured_llm =llm.with_structured_output(ToolInfo)
         messages = [AIMessage(content=prompt)]
-        response=structured_llm.invoke(messages)
-        print(response)
+        response=await gateway.ainvoke(messages, ToolInfo)
+        logger.debug("Tool suggestions: %s", response)
         if state.tools_selected:
             for tool in state.tools_selected:
                 if tool not in response.tools_needed:
                     response.tools_needed.append(tool)
 
-        return {"tools": ToolInfo(tools_needed=response.tools_needed, tools_suggested=response.tools_suggested), "context_history": context_history}
-
-    def check_requirements_node(self,state: AgentState) -> AgentState:
-        print("In check_requirements_node")
+        return {"tools": ToolInfo(tools_needed=response.tools_needed, tools_suggested=response.tools_suggested), "context_history": context_history, "available_tools": available_tools}
 
+    async def check_requirements_node(self,state: AgentState) -> AgentState:
+        logger.info("Checking requirements")
 
-        formatted_context_history = ""
-        if state.context_history:
-            for message in state.context_history:
-                role = message["role"].capitalize()
-                content = message["content"]
-                formatted_context_history += f"{role}: {content}\n"
+        tools_text = encode_tools(state.available_tools)
+        formatted_context_history = fit_history("check_requirements_node", transcript_for(state.context_history, state.history_trims), Check_Requirement_PROMPT, state.query, tools_text)
 
         tools_needed = [tool.replace("_", " ") for tool in state.tools.tools_needed if tool]
         tools_suggested = [tool.replace("_", " ") for tool in state.tools.tools_suggested if tool]
-        print(f"\n Tools needed: {tools_needed}")
-        print(f"\n Tools suggested: {tools_suggested}")
+        logger.debug("Tools needed: %s", tools_needed)
+        logger.debug("Tools suggested: %s", tools_suggested)
 
-        prompt= Check_Requirement_PROMPT.format(
+        prompt= render(
+            "Check_Requirement_PROMPT", Check_Requirement_PROMPT,
+            raw={"tools_needed": tools_needed, "tools_suggested": tools_suggested, "available_tools": state.available_tools},
             query=state.query,
-            tools_needed=tools_needed,
-            tools_suggested=tools_suggested,
+            tools_needed=encode_names(tools_needed),
+            tools_suggested=encode_names(tools_suggested),
             context_history= formatted_context_history,
-            available_tools=state.available_tools)
+            available_tools=tools_text)
 
         messages = [AIMessage(content=prompt)]
-        structured_llm = llm.with_structured_output(CheckRequirementsResponse)
-        response=structured_llm.invoke(messages)
-        print(f"\n {response.response}")
+        response=await gateway.ainvoke(messages, CheckRequirementsResponse, cache_node="check_requirements_node")
+        logger.debug("Check requirements response: %s", response.response)
         context_history = state.context_history + [{"role": "assistant", "content": response.response}]
         return {"context_history": context_history, "response": response.response}
 
-    def generate_summary(self, state: AgentState) -> str:
+    async def generate_summary(self, state: AgentState) -> str:
+        if self.defer_summary:
+            return {}
+        return await self.summarize(state)
+
+    async def summarize(self, state: AgentState) -> dict:
+
+        transcript = transcript_for(state.context_history, state.history_trims)
+        if needs_full_summary(state.summary, state.summary_upto, state.summary_turns, state.context_history, state.refresh_summary):
+            formatted_context_history = await full_summary_history(gateway, "generate_summary", transcript, state.summary, state.summary_upto, GENERATE_SUMMARY_PROMPT, state.query)
+            prompt = render(
+                "GENERATE_SUMMARY_PROMPT", GENERATE_SUMMARY_PROMPT,
+                raw={"tools_needed": state.tools.tools_needed, "tools_suggested": state.tools.tools_suggested},
+                query=state.query,
+                context_history=formatted_context_history,
+                tools_needed=encode_names(state.tools.tools_needed),
+                tools_suggested=encode_names(state.tools.tools_suggested)
+            )
+            summary_turns = 0
+        else:
+            # Fold only the messages since the last summary into it; the tool lists are small and always current
+            prompt = render(
+                "UPDATE_SUMMARY_PROMPT", UPDATE_SUMMARY_PROMPT,
+                raw={"details": f"Selected tools: {state.tools.tools_needed}\nSuggested tools: {state.tools.tools_suggested}"},
+                summary=state.summary,
+                new_messages=transcript.since(state.summary_upto),
+                details=f"Selected tools: {encode_names(state.tools.tools_needed)}\nSuggested tools: {encode_names(state.tools.tools_suggested)}",
+            )
+            summary_turns = state.summary_turns + 1
 
-        formatted_context_history = ""
-        if state.context_history:
-            for message in state.context_history:
-                role = message["role"].capitalize()
-                content = message["content"]
-                formatted_context_history += f"{role}: {content}\n"
-        
-        prompt = GENERATE_SUMMARY_PROMPT.format(
-            query=state.query,
-            context_history=formatted_context_history,
-            tools_needed=state.tools.tools_needed,
-            tools_suggested=state.tools.tools_suggested
-        )
         messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
-        print(f"\n Summary: {response.content}")
-        return {"summary": response.content}
+        response = await gateway.ainvoke(messages)
+        logger.debug("Summary: %s", response.content)
+        return {"summary": response.content, "summary_upto": len(state.context_history), "summary_turns": summary_turns, "refresh_summary": False}
 
-    def user_confirmation(self, state: AgentState) -> AgentState:
-        print("In User confirmation")
+    async def user_confirmation(self, state: AgentState) -> AgentState:
+        logger.info("In user confirmation")
 
-        prompt = USER_CONFIRMATION_PROMPT.format(
+        prompt = render(
+            "USER_CONFIRMATION_PROMPT", USER_CONFIRMATION_PROMPT,
+            raw={"tools_needed": state.tools.tools_needed, "tools_suggested": state.tools.tools_suggested},
             summary=state.summary,
-            tools_needed=state.tools.tools_needed,
-            tools_suggested=state.tools.tools_suggested
+            tools_needed=encode_names(state.tools.tools_needed),
+            tools_suggested=encode_names(state.tools.tools_suggested)
         )
         messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
-        print(f"\n User Confirmation: {response.content}")
+        response = await gateway.ainvoke(messages, cache_node="user_confirmation")
+        logger.debug("User confirmation: %s", response.content)
         return {"response": response.content}
 
     def visualize(self):
@@ -0,0 +1,88 @@
+import asyncio
+from typing import Dict, List, Optional
+
+import logging
+from logging import getLogger
+
+from pydantic import BaseModel
+from langchain_core.messages import AIMessage
+
+from vector_store import vector_stores
+
+logger = getLogger("pre_answer")
+logger.setLevel(logging.DEBUG)
+
+PRE_ANSWER_K = 3
+PRE_ANSWER_CONCURRENCY = 4
+ANSWER_CONFIDENCE_THRESHOLD = 0.8
+
+PRE_ANSWER_PROMPT = """
+You are checking whether the user's uploaded business documents already answer an onboarding question.
+
+Question ({section}):
+{question}
+
+Numbered excerpts from the documents:
+{excerpts}
+
+Answer only from the excerpts above:
+- If they answer the question, set "answered" to true, give the answer in one or two sentences and set "evidence" to the number of the excerpt that supports it.
+- If they do not, set "answered" to false and "evidence" to -1.
+- Set "confidence" between 0 and 1 to how certain you are that the answer is complete and correct.
+"""
+
+
+class PreAnswer(BaseModel):
+    answered: bool = False
+    answer: str = ""
+    confidence: float = 0.0
+    evidence: int = -1
+
+
+def is_answered(answer: Optional[dict]) -> bool:
+    return bool(answer) and answer.get("answered", False) and answer.get("confidence", 0.0) >= ANSWER_CONFIDENCE_THRESHOLD
+
+
+async def pre_answer_questions(gateway, questions: List[dict], k: int = PRE_ANSWER_K, concurrency: int = PRE_ANSWER_CONCURRENCY, namespace: Optional[str] = None) -> List[dict]:
+    """One answer per question ({answered, answer, confidence, evidence}), from the documents of `namespace` alone."""
+    if not questions:
+        return []
+
+    retrieved = await vector_stores.asearch_batch([question["question"] for question in questions], k=k, namespace=namespace)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(question: dict, documents: list) -> dict:
+        if not documents:
+            return PreAnswer().model_dump() | {"evidence": None}
+        prompt = PRE_ANSWER_PROMPT.format(
+            section=question.get("section", ""),
+            question=question["question"],
+            excerpts="\n".join(f"[{index}] {document.page_content.strip()}" for index, document in enumerate(documents)),
+        )
+        async with semaphore:
+            try:
+                response = await gateway.ainvoke([AIMessage(content=prompt)], PreAnswer)
+            except Exception as e:
+                logger.warning("Pre-answering %r failed: %s", question["question"], e)
+                response = PreAnswer()
+        evidence = None
+        if response.answered and 0 <= response.evidence < len(documents):
+            document = documents[response.evidence]
+            evidence = {"rank": response.evidence, **{key: document.metadata[key] for key in ("source", "chunk") if key in document.metadata}}
+        return response.model_dump() | {"evidence": evidence}
+
+    answers = await asyncio.gather(*(answer(question, documents) for question, documents in zip(questions, retrieved)))
+    logger.info("Documents answer %d of %d pending questions", sum(map(is_answered, answers)), len(answers))
+    return list(answers)
+
+
+def next_open_question(questions: List[dict], answers: List[dict], start: int) -> int:
+    """Index of the first question from `start` on that the documents do not already answer."""
+    index = start
+    while index < len(questions) and index < len(answers) and is_answered(answers[index]):
+        index += 1
+    return index
+
+
+def answered_summary(questions: List[dict], answers: List[dict]) -> Dict[str, str]:
+    return {question["question"]: answer["answer"] for question, answer in zip(questions, answers) if is_answered(answer)}
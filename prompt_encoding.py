@@ -0,0 +1,95 @@
+import os
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Mapping, Optional, Union
+
+import logging
+from logging import getLogger
+
+from instrumentation import metrics
+from token_budget import count_tokens, head_tokens, tokens_saved
+
+logger = getLogger("prompt_encoding")
+logger.setLevel(logging.DEBUG)
+
+TOOL_DESCRIPTION_CHARS = 80
+SUMMARY_TOKENS = 300
+TRUNCATION_MARK = " [...]"
+# Counting what each prompt saves formats it a second time and tokenizes both; the benchmark turns this on
+PROMPT_TOKEN_REPORT = os.getenv("PROMPT_TOKEN_REPORT", "0") == "1"
+
+prompt_tokens = metrics.counter("prompt_template_tokens_total", "Prompt tokens per template, as sent (compact) and as the raw reprs would have been (raw), with PROMPT_TOKEN_REPORT=1", ("template", "encoding"))
+
+# template -> {"calls", "before", "after"}, in tokens
+template_report: Dict[str, Dict[str, int]] = defaultdict(lambda: {"calls": 0, "before": 0, "after": 0})
+
+
+def encode_names(names: Iterable[str]) -> str:
+    names = list(dict.fromkeys(name for name in names if name))
+    return ", ".join(names) if names else "none"
+
+
+def encode_tools(tools: Union[Mapping[str, str], Iterable[str]]) -> str:
+    """One `name: description` line per tool; descriptions are cut to TOOL_DESCRIPTION_CHARS."""
+    if not isinstance(tools, Mapping):
+        return encode_names(tools)
+    if not tools:
+        return "none"
+    lines = []
+    for name, description in tools.items():
+        description = " ".join(str(description or "").split())
+        if len(description) > TOOL_DESCRIPTION_CHARS:
+            description = description[:TOOL_DESCRIPTION_CHARS].rstrip() + "..."
+        lines.append(f"{name}: {description}" if description else name)
+    return "\n".join(lines)
+
+
+def encode_checklist(checklist: Union[Mapping[str, bool], Any]) -> str:
+    """The open categories, one per line; confirmed ones are named once instead of listed as `key: True`."""
+    if hasattr(checklist, "model_dump"):
+        checklist = checklist.model_dump()
+    open_fields = [field for field, done in checklist.items() if not done]
+    confirmed = [field for field, done in checklist.items() if done]
+    lines = ["Open:", *(f"- {field}" for field in open_fields)] if open_fields else ["Open: none"]
+    if confirmed:
+        lines.append(f"Already confirmed: {', '.join(confirmed)}")
+    return "\n".join(lines)
+
+
+def encode_summary(text: str, max_tokens: int = SUMMARY_TOKENS) -> str:
+    """The start of a long summary, cut on a token boundary and marked as cut."""
+    text = (text or "").strip()
+    if count_tokens(text) <= max_tokens:
+        return text
+    return head_tokens(text, max_tokens).rstrip() + TRUNCATION_MARK
+
+
+def render(name: str, template: str, raw: Optional[Dict[str, Any]] = None, **values: Any) -> str:
+    """Formats `template` with the compact `values`; with PROMPT_TOKEN_REPORT, records its size against the `raw` values they replace."""
+    prompt = template.format(**values)
+    if not PROMPT_TOKEN_REPORT:
+        return prompt
+    after = count_tokens(prompt)
+    before = count_tokens(template.format(**{**values, **raw})) if raw else after
+    report = template_report[name]
+    report["calls"] += 1
+    report["before"] += before
+    report["after"] += after
+    prompt_tokens.inc(name, "raw", amount=before)
+    prompt_tokens.inc(name, "compact", amount=after)
+    if before > after:
+        logger.debug("%s: %d -> %d prompt tokens", name, before, after)
+    return prompt
+
+
+def token_report() -> Dict[str, Dict[str, Any]]:
+    """Per template: calls and mean prompt tokens before and after compact encoding; per node: history tokens trimmed."""
+    rows = {}
+    for name, report in sorted(template_report.items()):
+        calls = report["calls"] or 1
+        rows[name] = {
+            "calls": report["calls"],
+            "before": round(report["before"] / calls, 1),
+            "after": round(report["after"] / calls, 1),
+            "saved_pct": round(100 * (1 - report["after"] / report["before"]), 1) if report["before"] else 0.0,
+        }
+    return {"templates": rows, "history_saved": dict(sorted(tokens_saved.items()))}
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import logging
+from logging import getLogger
+
+
+logger = getLogger("rag_jobs")
+logger.setLevel(logging.DEBUG)
+
+RAG_JOB_DB_PATH = "rag_jobs.sqlite"
+MAX_CONCURRENT_RAG_JOBS = 2
+# A worker renews the leases on its jobs every RAG_JOB_LEASE_SECONDS / 3; another worker takes over once one lapses
+RAG_JOB_LEASE_SECONDS = 60
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class RAGJobNotFound(KeyError):
+    pass
+
+
+@lru_cache(maxsize=1)
+def shared_rag_agent():
+    # ag2 is heavy to import and only needed once documents are analysed
+    from requirements_agent.ag2 import RAGAgent
+
+    return RAGAgent()
+
+
+async def run_rag_analysis(results: Optional[Dict[str, Any]] = None, on_iteration: Optional[Callable[[int, Dict[str, Any]], Awaitable[None]]] = None, iteration: int = 0) -> Dict[str, Any]:
+    """Steps the RAG graph until it reaches its breakpoint, starting from (possibly checkpointed) results."""
+    results = dict(results or {})
+    rag_agent = shared_rag_agent()
+    while not results.get("breakpoint", False):
+        results = await rag_agent.graph.ainvoke(results)
+        iteration += 1
+        if on_iteration is not None:
+            await on_iteration(iteration, results)
+    return results
+
+
+def rag_output(results: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "RAG_summary": results.get("summary", ""),
+        "unanswered_questions": results.get("unanswered_questions", []),
+        "breakpoint": results.get("breakpoint", False),
+    }
+
+
+class RAGJobRunner:
+    """Runs document analyses in the background, at most max_concurrent at a time.
+
+    Each job's intermediate RAG-graph results are checkpointed to SQLite after every iteration, so jobs
+    interrupted by a crash or restart carry on from their last iteration when resume() is called.
+    A job is owned by one runner at a time, under a lease that run_leases() keeps renewed; runners sharing
+    the database only take over jobs whose lease has lapsed.
+    """
+
+    def __init__(
+        self,
+        path: str = RAG_JOB_DB_PATH,
+        max_concurrent: int = MAX_CONCURRENT_RAG_JOBS,
+        on_complete: Optional[Callable[[str, Dict[str, Any]], Awaitable[None]]] = None,
+    ):
+        self.path = path
+        self.owner = uuid.uuid4().hex
+        self.on_complete = on_complete
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS rag_jobs ("
+                "job_id TEXT PRIMARY KEY, session_id TEXT, status TEXT, iteration INTEGER, "
+                "checkpoint BLOB, output TEXT, error TEXT, created REAL, updated REAL, owner TEXT, lease_until REAL)"
+            )
+            columns = {column[1] for column in self._conn.execute("PRAGMA table_info(rag_jobs)")}
+            for column, kind in (("owner", "TEXT"), ("lease_until", "REAL")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE rag_jobs ADD COLUMN {column} {kind}")
+        return self._conn
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+            self.conn.commit()
+        return rows
+
+    def _update(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            changed = self.conn.execute(sql, params).rowcount
+            self.conn.commit()
+        return changed
+
+    def submit(self, session_id: Optional[str] = None) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO rag_jobs (job_id, session_id, status, iteration, created, updated, owner, lease_until) VALUES (?, ?, ?, 0, ?, ?, ?, ?)",
+            (job_id, session_id, QUEUED, now, now, self.owner, now + RAG_JOB_LEASE_SECONDS),
+        )
+        self._start(job_id)
+        return job_id
+
+    def _start(self, job_id: str):
+        self.tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    def resume(self) -> int:
+        """Claims unfinished jobs whose lease has lapsed (or that have no owner) and runs them here."""
+        now = time.time()
+        with self._lock:
+            # A single UPDATE is atomic across processes, so each lapsed job goes to exactly one runner
+            self.conn.execute(
+                "UPDATE rag_jobs SET owner = ?, lease_until = ? WHERE status IN (?, ?) AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?)",
+                (self.owner, now + RAG_JOB_LEASE_SECONDS, QUEUED, RUNNING, now),
+            )
+            self.conn.commit()
+            job_ids = [row[0] for row in self.conn.execute("SELECT job_id FROM rag_jobs WHERE owner = ? AND status IN (?, ?)", (self.owner, QUEUED, RUNNING))]
+        job_ids = [job_id for job_id in job_ids if job_id not in self.tasks]
+        for job_id in job_ids:
+            self._start(job_id)
+        if job_ids:
+            logger.info("Resuming %d RAG jobs", len(job_ids))
+        return len(job_ids)
+
+    async def run_leases(self, interval: float = RAG_JOB_LEASE_SECONDS / 3):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self._update(
+                    "UPDATE rag_jobs SET lease_until = ? WHERE owner = ? AND status IN (?, ?)",
+                    (time.time() + RAG_JOB_LEASE_SECONDS, self.owner, QUEUED, RUNNING),
+                )
+                # Jobs of a runner that stopped renewing (crashed or shut down) move here
+                self.resume()
+            except Exception as e:
+                logger.error("Renewing RAG job leases failed: %s", e)
+
+    def status(self, job_id: str) -> Dict[str, Any]:
+        rows = self._execute(
+            "SELECT session_id, status, iteration, output, error, created, updated FROM rag_jobs WHERE job_id = ?",
+            (job_id,),
+        )
+        if not rows:
+            raise RAGJobNotFound(job_id)
+        session_id, status, iteration, output, error, created, updated = rows[0]
+        return {
+            "job_id": job_id,
+            "session_id": session_id,
+            "status": status,
+            "iteration": iteration,
+            "result": json.loads(output) if output else None,
+            "error": error,
+            "created": created,
+            "updated": updated,
+        }
+
+    async def wait(self, job_id: str) -> Dict[str, Any]:
+        task = self.tasks.get(job_id)
+        if task is not None:
+            await asyncio.shield(task)
+        return self.status(job_id)
+
+    async def _run(self, job_id: str):
+        try:
+            async with self.semaphore:
+                session_id, iteration, checkpoint = self._execute(
+                    "SELECT session_id, iteration, checkpoint FROM rag_jobs WHERE job_id = ?", (job_id,)
+                )[0]
+                if not self._update("UPDATE rag_jobs SET status = ?, updated = ? WHERE job_id = ? AND owner = ?", (RUNNING, time.time(), job_id, self.owner)):
+                    logger.info("RAG job %s was taken over by another runner", job_id)
+                    return
+
+                async def save(iteration: int, results: Dict[str, Any]):
+                    try:
+                        checkpoint = pickle.dumps(results)
+                    except Exception as e:
+                        # The previous checkpoint stays; a resumed job just repeats the iterations since then
+                        logger.warning("RAG job %s iteration %d could not be checkpointed: %s", job_id, iteration, e)
+                        return
+                    if not self._update(
+                        "UPDATE rag_jobs SET iteration = ?, checkpoint = ?, updated = ? WHERE job_id = ? AND owner = ?",
+                        (iteration, checkpoint, time.time(), job_id, self.owner),
+                    ):
+                        raise RuntimeError(f"RAG job {job_id} was taken over by another runner")
+                    logger.debug("RAG job %s finished iteration %d", job_id, iteration)
+
+                results = {}
+                if checkpoint:
+                    try:
+                        results = pickle.loads(checkpoint)
+                    except Exception as e:
+                        logger.warning("RAG job %s checkpoint could not be loaded, starting over: %s", job_id, e)
+                        iteration = 0
+                results = await run_rag_analysis(results, on_iteration=save, iteration=iteration)
+                output = rag_output(results)
+                if session_id and self.on_complete is not None:
+                    await self.on_complete(session_id, output)
+                self._update(
+                    "UPDATE rag_jobs SET status = ?, output = ?, updated = ? WHERE job_id = ? AND owner = ?",
+                    (DONE, json.dumps(output, default=str), time.time(), job_id, self.owner),
+                )
+                logger.info("RAG job %s done", job_id)
+        except Exception as e:
+            logger.error("RAG job %s failed: %s", job_id, e)
+            self._update("UPDATE rag_jobs SET status = ?, error = ?, updated = ? WHERE job_id = ? AND owner = ?", (FAILED, str(e), time.time(), job_id, self.owner))
+        finally:
+            self.tasks.pop(job_id, None)
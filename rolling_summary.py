@@ -0,0 +1,87 @@
+from typing import Any, Dict, List
+
+import logging
+from logging import getLogger
+
+from langchain_core.messages import AIMessage
+
+from token_budget import count_tokens, history_budget, head_tokens
+
+logger = getLogger("rolling_summary")
+logger.setLevel(logging.DEBUG)
+
+FULL_SUMMARY_EVERY = 8
+EARLIER_HISTORY = "Summary of the earlier conversation:\n{summary}\n\nLatest messages:\n{messages}"
+
+UPDATE_SUMMARY_PROMPT = """
+You are maintaining the running summary of an onboarding conversation that is shown to the user in a sidebar.
+
+Here is the current summary:
+{summary}
+
+Here are the messages exchanged since that summary was written:
+{new_messages}
+
+{details}
+
+Rewrite the summary so that it also covers the new messages:
+- Keep everything from the current summary that is still true.
+- Update or replace anything the new messages change or correct.
+- Keep the same structure, headings and tone as the current summary, and keep it about as concise.
+- Respond with the updated summary only.
+"""
+
+
+def needs_full_summary(summary: str, summary_upto: int, summary_turns: int, context_history: List[dict], refresh: bool = False) -> bool:
+    # A rolling update is only safe while the history the summary covered is still there
+    return (
+        refresh
+        or not summary
+        or summary_upto > len(context_history)
+        or summary_turns + 1 >= FULL_SUMMARY_EVERY
+    )
+
+
+def tail_rewritten(summary_upto: int, kept: int) -> Dict[str, Any]:
+    """State updates for a node that keeps only the first `kept` messages of the history before appending its own."""
+    if summary_upto <= kept:
+        return {}
+    # The summary covers a message that is gone, so it is regenerated instead of extended
+    return {"summary_upto": kept, "refresh_summary": True}
+
+
+async def fold_into_summary(gateway, transcript, summary: str, start: int, end: int, budget: int) -> str:
+    """`summary` extended with messages [start, end), folded in chunks of at most `budget` tokens."""
+    while start < end:
+        # The chunk ends where the next message would not fit; a single oversized message goes alone
+        chunk_end = start + 1
+        counts = transcript.token_counts()
+        used = counts[start]
+        while chunk_end < end and used + counts[chunk_end] <= budget:
+            used += counts[chunk_end]
+            chunk_end += 1
+        prompt = UPDATE_SUMMARY_PROMPT.format(summary=summary or "(nothing yet)", new_messages="\n".join(transcript.lines[start:chunk_end]), details="")
+        summary = (await gateway.ainvoke([AIMessage(content=prompt)])).content
+        start = chunk_end
+    return summary
+
+
+async def full_summary_history(gateway, node: str, transcript, summary: str, summary_upto: int, *prompt_parts: str) -> str:
+    """The whole conversation for a full re-summarise within the node's history budget.
+
+    Messages that do not fit are not dropped: they are represented by the current summary when it
+    covers them, and otherwise first folded into it chunk by chunk.
+    """
+    budget = history_budget(node, *prompt_parts)
+    if transcript.window_start(budget) == 0:
+        return transcript.render()
+
+    # Half the budget for the latest messages verbatim, the rest for the summary of what precedes them
+    start = max(1, transcript.window_start(budget // 2))
+    covered = min(summary_upto, start) if summary else 0
+    if covered < start:
+        logger.info("%s: folding %d messages into the summary before re-summarising", node, start - covered)
+        summary = await fold_into_summary(gateway, transcript, summary if covered else "", covered, start, budget)
+    if count_tokens(summary) > budget // 2:
+        summary = head_tokens(summary, budget // 2)
+    return EARLIER_HISTORY.format(summary=summary, messages="\n".join(transcript.lines[start:]))
@@ -0,0 +1,259 @@
+import json
+import os
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+logger = getLogger("session_backend")
+logger.setLevel(logging.DEBUG)
+
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_META_PATH = os.getenv("SESSION_META_PATH", "session_meta.sqlite")
+TURN_LEASE_SECONDS = 300
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+
+
+class SessionConflict(Exception):
+    """The session moved past the version the caller expected."""
+
+
+class SessionBusy(SessionConflict):
+    """Another turn or update holds the session right now."""
+
+
+class SessionBackend(ABC):
+    """Session bookkeeping every worker must agree on: existence, last use, version, lease and turn results.
+
+    A turn claims the session with `claim(..., bump=True)`, which checks the caller's expected version,
+    increments it and takes a lease in one step; background updates claim without bumping. The state
+    itself lives in the LangGraph checkpointer.
+    """
+
+    @abstractmethod
+    def create(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """{"version", "last_seen", "lease_until"}, or None for an unknown session."""
+
+    @abstractmethod
+    def touch(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def claim(self, session_id: str, expected_version: Optional[int] = None, bump: bool = True, lease_seconds: float = TURN_LEASE_SECONDS) -> int:
+        """Takes the lease and returns the (new) version; raises SessionConflict or SessionBusy."""
+
+    @abstractmethod
+    def release(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def idle(self, max_idle_seconds: float) -> List[str]:
+        ...
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        ...
+
+    @abstractmethod
+    def reserve(self, session_id: str, key: str) -> Optional[Tuple[str, Optional[dict]]]:
+        """Reserves idempotency key `key`; returns None if reserved now, else (status, response) of its holder.
+
+        A key still "running" after a turn lease has passed belongs to a crashed worker and is taken over.
+        """
+
+    @abstractmethod
+    def complete(self, session_id: str, key: str, response: dict):
+        ...
+
+    @abstractmethod
+    def forget(self, session_id: str, key: str):
+        ...
+
+
+class MemorySessionBackend(SessionBackend):
+    """Process-local backend: correct for a single worker only."""
+
+    def __init__(self):
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        self.turns: Dict[Tuple[str, str], Tuple[str, Optional[dict], float]] = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id: str):
+        with self._lock:
+            self.sessions.setdefault(session_id, {"version": 0, "last_seen": time.time(), "lease_until": 0.0})
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        record = self.sessions.get(session_id)
+        return dict(record) if record is not None else None
+
+    def touch(self, session_id: str):
+        with self._lock:
+            self.sessions.setdefault(session_id, {"version": 0, "last_seen": 0.0, "lease_until": 0.0})["last_seen"] = time.time()
+
+    def claim(self, session_id: str, expected_version: Optional[int] = None, bump: bool = True, lease_seconds: float = TURN_LEASE_SECONDS) -> int:
+        now = time.time()
+        with self._lock:
+            record = self.sessions.setdefault(session_id, {"version": 0, "last_seen": now, "lease_until": 0.0})
+            if expected_version is not None and record["version"] != expected_version:
+                raise SessionConflict(f"Session {session_id} is at version {record['version']}, not {expected_version}")
+            if record["lease_until"] > now:
+                raise SessionBusy(f"Session {session_id} is busy")
+            record["version"] += 1 if bump else 0
+            record["lease_until"] = now + lease_seconds
+            record["last_seen"] = now
+            return record["version"]
+
+    def release(self, session_id: str):
+        with self._lock:
+            if session_id in self.sessions:
+                self.sessions[session_id]["lease_until"] = 0.0
+
+    def idle(self, max_idle_seconds: float) -> List[str]:
+        now = time.time()
+        with self._lock:
+            for key, (_, _, created) in list(self.turns.items()):
+                if now - created > IDEMPOTENCY_TTL_SECONDS:
+                    del self.turns[key]
+            return [session_id for session_id, record in self.sessions.items() if now - record["last_seen"] > max_idle_seconds and record["lease_until"] <= now]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self.sessions.pop(session_id, None)
+            for key in [key for key in self.turns if key[0] == session_id]:
+                del self.turns[key]
+
+    def reserve(self, session_id: str, key: str) -> Optional[Tuple[str, Optional[dict]]]:
+        now = time.time()
+        with self._lock:
+            entry = self.turns.get((session_id, key))
+            if entry is not None and not (entry[0] == "running" and now - entry[2] > TURN_LEASE_SECONDS):
+                return entry[0], entry[1]
+            self.turns[(session_id, key)] = ("running", None, now)
+            return None
+
+    def complete(self, session_id: str, key: str, response: dict):
+        with self._lock:
+            self.turns[(session_id, key)] = ("done", response, time.time())
+
+    def forget(self, session_id: str, key: str):
+        with self._lock:
+            self.turns.pop((session_id, key), None)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Backend in a SQLite file shared by every worker on the host; each check-and-set is one UPDATE."""
+
+    def __init__(self, path: str = SESSION_META_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_meta ("
+                "session_id TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0, last_seen REAL NOT NULL, lease_until REAL NOT NULL DEFAULT 0)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_turns ("
+                "session_id TEXT, key TEXT, status TEXT, response TEXT, created REAL, PRIMARY KEY (session_id, key))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS session_meta_last_seen ON session_meta (last_seen)")
+            self._conn.commit()
+        return self._conn
+
+    def _write(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            cursor = self.conn.execute(sql, params)
+            self.conn.commit()
+            return cursor.rowcount
+
+    def create(self, session_id: str):
+        self._write("INSERT OR IGNORE INTO session_meta (session_id, last_seen) VALUES (?, ?)", (session_id, time.time()))
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self.conn.execute("SELECT version, last_seen, lease_until FROM session_meta WHERE session_id = ?", (session_id,)).fetchone()
+        return {"version": row[0], "last_seen": row[1], "lease_until": row[2]} if row else None
+
+    def touch(self, session_id: str):
+        now = time.time()
+        self._write(
+            "INSERT INTO session_meta (session_id, last_seen) VALUES (?, ?) ON CONFLICT (session_id) DO UPDATE SET last_seen = excluded.last_seen",
+            (session_id, now),
+        )
+
+    def claim(self, session_id: str, expected_version: Optional[int] = None, bump: bool = True, lease_seconds: float = TURN_LEASE_SECONDS) -> int:
+        now = time.time()
+        with self._lock:
+            self.conn.execute("INSERT OR IGNORE INTO session_meta (session_id, last_seen) VALUES (?, ?)", (session_id, now))
+            claimed = self.conn.execute(
+                "UPDATE session_meta SET version = version + ?, lease_until = ?, last_seen = ? "
+                "WHERE session_id = ? AND lease_until <= ? AND (? IS NULL OR version = ?)",
+                (1 if bump else 0, now + lease_seconds, now, session_id, now, expected_version, expected_version),
+            ).rowcount
+            version, lease_until = self.conn.execute("SELECT version, lease_until FROM session_meta WHERE session_id = ?", (session_id,)).fetchone()
+            self.conn.commit()
+        if claimed:
+            return version
+        if expected_version is not None and version != expected_version:
+            raise SessionConflict(f"Session {session_id} is at version {version}, not {expected_version}")
+        raise SessionBusy(f"Session {session_id} is busy for another {lease_until - now:.0f}s")
+
+    def release(self, session_id: str):
+        self._write("UPDATE session_meta SET lease_until = 0 WHERE session_id = ?", (session_id,))
+
+    def idle(self, max_idle_seconds: float) -> List[str]:
+        now = time.time()
+        self._write("DELETE FROM session_turns WHERE created < ?", (now - IDEMPOTENCY_TTL_SECONDS,))
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT session_id FROM session_meta WHERE last_seen < ? AND lease_until <= ?", (now - max_idle_seconds, now)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self.conn.execute("DELETE FROM session_meta WHERE session_id = ?", (session_id,))
+            self.conn.execute("DELETE FROM session_turns WHERE session_id = ?", (session_id,))
+            self.conn.commit()
+
+    def reserve(self, session_id: str, key: str) -> Optional[Tuple[str, Optional[dict]]]:
+        now = time.time()
+        with self._lock:
+            inserted = self.conn.execute(
+                "INSERT INTO session_turns (session_id, key, status, created) VALUES (?, ?, 'running', ?) "
+                "ON CONFLICT (session_id, key) DO UPDATE SET created = excluded.created "
+                "WHERE session_turns.status = 'running' AND session_turns.created < ?",
+                (session_id, key, now, now - TURN_LEASE_SECONDS),
+            ).rowcount
+            row = None if inserted else self.conn.execute("SELECT status, response FROM session_turns WHERE session_id = ? AND key = ?", (session_id, key)).fetchone()
+            self.conn.commit()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    def complete(self, session_id: str, key: str, response: dict):
+        self._write("UPDATE session_turns SET status = 'done', response = ? WHERE session_id = ? AND key = ?", (json.dumps(response, default=str), session_id, key))
+
+    def forget(self, session_id: str, key: str):
+        self._write("DELETE FROM session_turns WHERE session_id = ? AND key = ?", (session_id, key))
+
+
+def session_backend_from_env(backend: str = SESSION_BACKEND) -> SessionBackend:
+    if backend == "sqlite":
+        return SQLiteSessionBackend()
+    if backend == "memory":
+        return MemorySessionBackend()
+    raise ValueError(f"Unknown SESSION_BACKEND '{backend}', expected 'memory' or 'sqlite'")
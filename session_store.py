@@ -0,0 +1,200 @@
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+from session_backend import SessionBackend, SessionBusy, TURN_LEASE_SECONDS, session_backend_from_env
+from streaming import stream_graph
+
+logger = getLogger("session_store")
+logger.setLevel(logging.DEBUG)
+
+SESSION_DB_PATH = "sessions.sqlite"
+MAX_IDLE_SECONDS = 30 * 60
+MAX_STATE_BYTES = 256 * 1024
+EVICTION_INTERVAL_SECONDS = 60
+CLAIM_POLL_SECONDS = 0.1
+
+
+class SessionNotFound(KeyError):
+    pass
+
+
+def state_size(values: Dict[str, Any]) -> int:
+    return len(json.dumps(values, default=lambda o: o.model_dump() if hasattr(o, "model_dump") else str(o)))
+
+
+class SessionStore:
+    """Keeps agent state on the server, one LangGraph checkpoint thread per session.
+
+    Everything workers must agree on (which sessions exist, their version, who is running a turn and
+    the responses to idempotent turns) goes through `backend`. With a shared backend and checkpointer,
+    any worker can serve any turn. Backend calls can wait on other workers' locks, so they run in a thread.
+    """
+
+    def __init__(self, graph, max_idle_seconds: float = MAX_IDLE_SECONDS, max_state_bytes: int = MAX_STATE_BYTES, backend: Optional[SessionBackend] = None):
+        self.graph = graph
+        self.checkpointer = graph.checkpointer
+        self.max_idle_seconds = max_idle_seconds
+        self.max_state_bytes = max_state_bytes
+        self.backend = backend or session_backend_from_env()
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def config(self, session_id: str) -> dict:
+        return {"configurable": {"thread_id": session_id}}
+
+    async def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.backend.create, session_id)
+        return session_id
+
+    async def touch(self, session_id: str):
+        await asyncio.to_thread(self.backend.touch, session_id)
+
+    async def exists(self, session_id: str) -> bool:
+        return await asyncio.to_thread(self.backend.get, session_id) is not None
+
+    async def version(self, session_id: str) -> int:
+        record = await asyncio.to_thread(self.backend.get, session_id)
+        return record["version"] if record else 0
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        return self.locks.setdefault(session_id, asyncio.Lock())
+
+    async def get_state(self, session_id: str) -> Dict[str, Any]:
+        snapshot = await self.graph.aget_state(self.config(session_id))
+        if not snapshot.values and not await self.exists(session_id):
+            raise SessionNotFound(session_id)
+        await self.touch(session_id)
+        return snapshot.values
+
+    async def claim(self, session_id: str, expected_version: Optional[int] = None, bump: bool = True) -> int:
+        # A stale expected version fails at once; without one, wait for the turn running on another worker
+        deadline = time.monotonic() + TURN_LEASE_SECONDS
+        while True:
+            try:
+                return await asyncio.to_thread(self.backend.claim, session_id, expected_version, bump)
+            except SessionBusy:
+                if expected_version is not None or time.monotonic() > deadline:
+                    raise
+            await asyncio.sleep(CLAIM_POLL_SECONDS)
+
+    async def run_turn(self, session_id: str, query: str, updates: Optional[Dict[str, Any]] = None, expected_version: Optional[int] = None) -> Tuple[Dict[str, Any], int]:
+        await self.get_state(session_id)
+        async with self.lock(session_id):
+            version = await self.claim(session_id, expected_version)
+            try:
+                payload = {**(updates or {}), "query": query}
+                result = await self.graph.ainvoke(payload, self.config(session_id))
+                result = await self.enforce_limits(session_id, result)
+            finally:
+                await asyncio.to_thread(self.backend.release, session_id)
+        return result, version
+
+    async def stream_turn(self, session_id: str, query: str, updates: Optional[Dict[str, Any]] = None, user_facing_nodes: Iterable[str] = (), expected_version: Optional[int] = None) -> AsyncIterator[Dict[str, Any]]:
+        await self.get_state(session_id)
+        async with self.lock(session_id):
+            version = await self.claim(session_id, expected_version)
+            try:
+                payload = {**(updates or {}), "query": query}
+                async for event in stream_graph(self.graph, payload, self.config(session_id), user_facing_nodes):
+                    if event["event"] == "end":
+                        event["state"] = await self.enforce_limits(session_id, event["state"])
+                        event["version"] = version
+                    yield event
+            finally:
+                await asyncio.to_thread(self.backend.release, session_id)
+
+    async def apply_update(self, session_id: str, values: Dict[str, Any], as_node: Optional[str] = None, expected: Optional[Dict[str, Any]] = None) -> bool:
+        """Writes `values`, unless a field in `expected` no longer has the given value; returns whether it wrote."""
+        # Background updates (summaries, document analysis) do not move the version clients hold
+        async with self.lock(session_id):
+            if not await self.exists(session_id):
+                # Deleted while the update was computed; writing would bring the session back
+                return False
+            await self.claim(session_id, bump=False)
+            try:
+                if expected:
+                    current = (await self.graph.aget_state(self.config(session_id))).values
+                    if any(current.get(field) != value for field, value in expected.items()):
+                        return False
+                await self.graph.aupdate_state(self.config(session_id), values, as_node=as_node)
+                return True
+            finally:
+                await asyncio.to_thread(self.backend.release, session_id)
+
+    async def reserve_turn(self, session_id: str, key: Optional[str]) -> Optional[Dict[str, Any]]:
+        """The stored response for idempotency key `key`, waiting if its turn is still running; None if the caller should run the turn."""
+        if not key:
+            return None
+        deadline = time.monotonic() + TURN_LEASE_SECONDS
+        while (entry := await asyncio.to_thread(self.backend.reserve, session_id, key)) is not None:
+            status, response = entry
+            if status == "done":
+                logger.info("Session %s: replaying turn %s", session_id, key)
+                return response
+            if time.monotonic() > deadline:
+                raise SessionBusy(f"Turn {key} of session {session_id} is still running")
+            await asyncio.sleep(CLAIM_POLL_SECONDS)
+        return None
+
+    async def complete_turn(self, session_id: str, key: Optional[str], response: Dict[str, Any]):
+        if key:
+            await asyncio.to_thread(self.backend.complete, session_id, key, response)
+
+    async def abandon_turn(self, session_id: str, key: Optional[str]):
+        # A failed turn may be retried under the same key
+        if key:
+            await asyncio.to_thread(self.backend.forget, session_id, key)
+
+    async def enforce_limits(self, session_id: str, values: Dict[str, Any]) -> Dict[str, Any]:
+        size = state_size(values)
+        if size <= self.max_state_bytes:
+            return values
+
+        # Drop the oldest turns, keeping the opening message, until the state fits again. Only turns the
+        # summary already covers go; the rest wait for the next summary pass, so nothing is lost from both.
+        context_history = list(values.get("context_history", []))
+        summarized = min(values.get("summary_upto", len(context_history)), len(context_history))
+        removed = 0
+        while len(context_history) > 2 and 1 + removed < summarized and size > self.max_state_bytes:
+            size -= len(json.dumps(context_history.pop(1)))
+            removed += 1
+        if not removed:
+            logger.info("Session %s over %d bytes, waiting for the summary before trimming", session_id, self.max_state_bytes)
+            return values
+        logger.info("Session %s over %d bytes, trimmed context_history to %d messages", session_id, self.max_state_bytes, len(context_history))
+        # Cached transcripts of this session are rebuilt instead of extended
+        updates = {"context_history": context_history, "history_trims": values.get("history_trims", 0) + 1}
+        if "summary_upto" in values:
+            # Keep the rolling summary pointing at the same messages after the shift
+            updates["summary_upto"] = values["summary_upto"] - removed
+        await self.graph.aupdate_state(self.config(session_id), updates)
+        return {**values, **updates}
+
+    async def delete(self, session_id: str):
+        # Under the session lock, so a background update that already checked the session exists cannot write it back
+        async with self.lock(session_id):
+            await self.checkpointer.adelete_thread(session_id)
+            await asyncio.to_thread(self.backend.delete, session_id)
+            self.locks.pop(session_id, None)
+
+    async def evict_idle(self) -> List[str]:
+        idle = [session_id for session_id in await asyncio.to_thread(self.backend.idle, self.max_idle_seconds) if not self.lock(session_id).locked()]
+        for session_id in idle:
+            await self.delete(session_id)
+        if idle:
+            logger.info("Evicted %d idle sessions", len(idle))
+        return idle
+
+    async def run_eviction(self, interval: float = EVICTION_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                logger.error("Session eviction failed: %s", e)
@@ -0,0 +1,59 @@
+import asyncio
+import inspect
+import time
+from typing import Any, Callable, Dict
+
+import logging
+from logging import getLogger
+
+logger = getLogger("startup")
+logger.setLevel(logging.DEBUG)
+
+
+class StartupReport:
+    """Wall time of each startup phase, counted from the import of this module.
+
+    Phases are either marked in sequence (`mark`) or run as warm-up steps (`warm_up`), which run
+    concurrently and are timed individually. A failed step is recorded and does not stop the others.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.last = self.started
+        self.phases: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.ready = False
+        self.total_ms = None
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases[name] = round((now - self.last) * 1000, 1)
+        self.last = now
+
+    async def _step(self, name: str, fn: Callable[[], Any]):
+        started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(fn):
+                await fn()
+            else:
+                # Blocking steps (files, sqlite, vector store clients) run off the event loop
+                await asyncio.to_thread(fn)
+        except Exception as e:
+            logger.warning("Warm-up step %s failed: %s", name, e)
+            self.errors[name] = str(e)
+        self.phases[f"warm_up.{name}"] = round((time.perf_counter() - started) * 1000, 1)
+
+    async def warm_up(self, steps: Dict[str, Callable[[], Any]]):
+        await asyncio.gather(*(self._step(name, fn) for name, fn in steps.items()))
+        self.finish()
+
+    def finish(self):
+        self.ready = True
+        self.total_ms = round((time.perf_counter() - self.started) * 1000, 1)
+        logger.info("Ready after %.1f ms: %s", self.total_ms, ", ".join(f"{name}={ms}ms" for name, ms in self.phases.items()))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "total_ms": self.total_ms, "phases": dict(self.phases), "errors": dict(self.errors)}
+
+
+startup = StartupReport()
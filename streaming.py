@@ -0,0 +1,92 @@
+import json
+import re
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+REPLY_FIELD = "response"
+_JSON_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+def last_assistant_message(context_history: List[dict]) -> str:
+    if context_history and context_history[-1]["role"] == "assistant":
+        return context_history[-1]["content"]
+    return ""
+
+
+def sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def partial_json_string(buffer: str, field: str = REPLY_FIELD) -> Optional[str]:
+    # Decode as much of a JSON string value as has arrived so far, e.g. '{"intro": false, "response": "Hel' -> 'Hel'.
+    match = re.search(rf'"{field}"\s*:\s*"', buffer)
+    if not match:
+        return None
+    chars = []
+    i = match.end()
+    while i < len(buffer):
+        char = buffer[i]
+        if char == '"':
+            break
+        if char == "\\":
+            if i + 1 >= len(buffer):
+                break
+            escape = buffer[i + 1]
+            if escape == "u":
+                if i + 6 > len(buffer):
+                    break
+                chars.append(chr(int(buffer[i + 2:i + 6], 16)))
+                i += 6
+                continue
+            chars.append(_JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        chars.append(char)
+        i += 1
+    return "".join(chars)
+
+
+def _chunk_text(chunk) -> str:
+    text = chunk.content if isinstance(chunk.content, str) else ""
+    for tool_chunk in getattr(chunk, "tool_call_chunks", None) or []:
+        text += tool_chunk.get("args") or ""
+    return text
+
+
+async def stream_graph(graph, payload: Dict[str, Any], config: Optional[dict] = None, user_facing_nodes: Iterable[str] = ()) -> AsyncIterator[Dict[str, Any]]:
+    """Translate graph.astream_events into node_start/node_end/token/reply events, ending with the final state.
+
+    Token events carry the LLM run id: a node can make several LLM calls (e.g. RAG hops) and only the
+    reply event emitted when the node finishes is authoritative.
+    """
+    nodes = set(graph.nodes) - {"__start__"}
+    user_facing_nodes = set(user_facing_nodes)
+    buffers: Dict[str, str] = {}
+    sent: Dict[str, int] = {}
+
+    async for event in graph.astream_events(payload, config, version="v2"):
+        kind = event["event"]
+        name = event["name"]
+        node = event.get("metadata", {}).get("langgraph_node")
+
+        if kind == "on_chain_start" and name == node and name in nodes:
+            yield {"event": "node_start", "node": name}
+
+        elif kind == "on_chat_model_stream" and node in user_facing_nodes:
+            run_id = event["run_id"]
+            buffers[run_id] = buffers.get(run_id, "") + _chunk_text(event["data"]["chunk"])
+            buffer = buffers[run_id]
+            text = partial_json_string(buffer) if buffer.lstrip().startswith("{") else buffer
+            if text and len(text) > sent.get(run_id, 0):
+                yield {"event": "token", "node": node, "run_id": run_id, "content": text[sent.get(run_id, 0):]}
+                sent[run_id] = len(text)
+
+        elif kind == "on_chain_end" and name == node and name in nodes:
+            yield {"event": "node_end", "node": name}
+            output = event["data"].get("output")
+            if name in user_facing_nodes and isinstance(output, dict):
+                reply = last_assistant_message(output.get("context_history") or [])
+                if reply:
+                    yield {"event": "reply", "node": name, "content": reply}
+
+        elif kind == "on_chain_end" and not event.get("parent_ids"):
+            yield {"event": "end", "state": event["data"].get("output")}
@@ -0,0 +1,65 @@
+import asyncio
+from typing import Dict, Set
+
+import logging
+from logging import getLogger
+
+logger = getLogger("summary_jobs")
+logger.setLevel(logging.DEBUG)
+
+
+class SummaryScheduler:
+    """Computes session summaries off the turn's critical path.
+
+    At most one job runs per session; scheduling while a job is running marks the session dirty
+    so that exactly one more pass runs afterwards with the latest state.
+    """
+
+    def __init__(self, sessions, agent, state_schema):
+        self.sessions = sessions
+        self.agent = agent
+        self.state_schema = state_schema
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.dirty: Set[str] = set()
+
+    def pending(self, session_id: str) -> bool:
+        task = self.tasks.get(session_id)
+        return task is not None and not task.done()
+
+    def schedule(self, session_id: str):
+        if self.pending(session_id):
+            self.dirty.add(session_id)
+            return
+        self.tasks[session_id] = asyncio.create_task(self._run(session_id))
+
+    async def _run(self, session_id: str):
+        try:
+            while True:
+                self.dirty.discard(session_id)
+                await self._summarize(session_id)
+                if session_id not in self.dirty:
+                    break
+        except Exception as e:
+            logger.error("Summary job for session %s failed: %s", session_id, e)
+        finally:
+            self.tasks.pop(session_id, None)
+            self.dirty.discard(session_id)
+
+    async def _summarize(self, session_id: str):
+        values = await self.sessions.get_state(session_id)
+        if not values:
+            return
+        update = await self.agent.summarize(self.state_schema(**values))
+        if not update:
+            return
+        # A turn may have written a newer summary inline while this one was generated
+        snapshot = {"summary": values.get("summary"), "summary_upto": values.get("summary_upto")}
+        if await self.sessions.apply_update(session_id, update, as_node="GenerateSummary", expected=snapshot):
+            logger.info("Summary for session %s updated", session_id)
+        else:
+            logger.info("Summary for session %s is stale, dropped", session_id)
+
+    async def wait(self, session_id: str):
+        task = self.tasks.get(session_id)
+        if task is not None:
+            await asyncio.shield(task)
@@ -1,20 +1,29 @@
 import time
+import json
+import asyncio
 import streamlit as st
 import requests
+import uuid
 
-from requirements_agent.ob_agent import OnboardingAgent, AgentState, BusinessInfoChecklist
 from config import FASTAPI_URL, GET_RAG_AGENT_URL
-from requirements_agent.utils.rag import process_document, Initialize_vector_store
+from ingestion import ingest_files
+
+SESSIONS_URL = FASTAPI_URL.rsplit("/", 1)[0] + "/sessions"
 
 st.set_page_config(page_title="🧠 Requirements Agent", page_icon="🤖")
 
 st.title("🧠 Requirements Agent")
 
 # ---- Initialize session state ----
-if "agent" not in st.session_state:
-    st.session_state.agent = OnboardingAgent()
-if "agent_state" not in st.session_state:
-    st.session_state.agent_state = AgentState()
+if "session_id" not in st.session_state:
+    response = requests.post(SESSIONS_URL, timeout=30)
+    response.raise_for_status()
+    st.session_state.session_id = response.json()["session_id"]
+    st.session_state.version = 0
+if "messages" not in st.session_state:
+    st.session_state.messages = []
+if "summary" not in st.session_state:
+    st.session_state.summary = ""
 if "show_uploader" not in st.session_state:
     st.session_state.show_uploader = False  # controls uploader visibility
 if "first_run" not in st.session_state:
@@ -24,8 +33,31 @@ if "documents_processed" not in st.session_state:
 if "documents_uploaded" not in st.session_state:
     st.session_state.documents_uploaded = False
 
-agent = st.session_state.agent
-state = st.session_state.agent_state
+turn_url = f"{SESSIONS_URL}/{st.session_state.session_id}/turn/stream"
+
+
+def refresh_version():
+    # After a conflict the next turn is sent against the version the server has now
+    try:
+        response = requests.get(f"{SESSIONS_URL}/{st.session_state.session_id}", timeout=30)
+        response.raise_for_status()
+        st.session_state.version = response.json()["version"]
+    except requests.RequestException:
+        st.session_state.version = None
+
+
+if "version" not in st.session_state:
+    refresh_version()
+
+
+def iter_sse(response):
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: ") and event:
+            yield event, json.loads(line[len("data: "):])
+            event = None
 
 
 # ---- Document uploader trigger ----
@@ -37,38 +69,21 @@ with st.sidebar:
     st.markdown("---")
 # ---- Sidebar summary ----
 st.sidebar.markdown("## 📝 Summary")
-if state.summary:
-    st.sidebar.markdown(state.summary)
+# Summaries are generated after the reply, so pick up the latest one on every rerun
+try:
+    summary_response = requests.get(f"{SESSIONS_URL}/{st.session_state.session_id}/summary", timeout=30)
+    summary_response.raise_for_status()
+    st.session_state.summary = summary_response.json().get("summary", "")
+except requests.RequestException:
+    pass
+if st.session_state.summary:
+    st.sidebar.markdown(st.session_state.summary)
 else:
     st.sidebar.markdown("*No summary available yet.*")
 
 # ---- Conversation display ----
 st.markdown("### 💬 Conversation")
-last_role = None
-context_history = state.context_history[1:] if state.documents_uploaded else state.context_history
-
-filtered_history = []
-skip_buffer = None
-
-for message in context_history:
-    role = message["role"]
-
-    if role == "assistant":
-        # Keep replacing until a different role comes
-        skip_buffer = message
-    else:
-        # If buffer exists, push it before adding user message
-        if skip_buffer:
-            filtered_history.append(skip_buffer)
-            skip_buffer = None
-        filtered_history.append(message)
-
-# If the conversation ends with assistant messages, keep the last one
-if skip_buffer:
-    filtered_history.append(skip_buffer)
-
-# Now render
-for message in filtered_history:
+for message in st.session_state.messages:
     with st.chat_message("user" if message["role"] == "user" else "assistant"):
         st.markdown(message["content"])
 
@@ -87,33 +102,48 @@ if user_input or (st.session_state.documents_processed and  st.session_state.fir
             st.markdown(user_input)
 
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            state.query = user_input
-            try:
-                payload = state.model_dump() 
-                print(f"Payload for agent invocation: {payload}")
-                response = requests.post(FASTAPI_URL, json=payload, timeout=800)
+        placeholder = st.empty()
+        placeholder.markdown("*Thinking...*")
+        try:
+            updates = {"documents_uploaded": True} if st.session_state.documents_uploaded else {}
+            # One key per user turn, kept until it completes, so a rerun resubmitting it gets the same reply back
+            pending = st.session_state.get("pending_turn")
+            if pending is None or pending["query"] != user_input:
+                pending = st.session_state.pending_turn = {"query": user_input, "key": uuid.uuid4().hex}
+            payload = {"query": user_input, "updates": updates, "version": st.session_state.version}
+            headers = {"Idempotency-Key": pending["key"]}
+            reply, run_id, streamed = "", None, ""
+            with requests.post(turn_url, json=payload, headers=headers, stream=True, timeout=800) as response:
+                if response.status_code == 409:
+                    refresh_version()
                 response.raise_for_status()
-                result = response.json()
-
-                updated_state_dict = result.get("result", {})
-                data_value = updated_state_dict.get("data")
-
-                if not isinstance(data_value, BusinessInfoChecklist):
-                    if isinstance(data_value, dict):
-                        data_value = BusinessInfoChecklist(**data_value)
-                    else:
-                        data_value = data_value.model_dump()
-
-                updated_state_dict["data"] = data_value
-                st.session_state.agent_state = AgentState(**updated_state_dict)
-                st.session_state.first_run = False
-
-                last_message = updated_state_dict.get("context_history", [])[-1]
-                if last_message and last_message["role"] == "assistant":
-                    st.markdown(last_message["content"])
-            except requests.RequestException as e:
-                st.error(f"Error invoking agent: {e}")
+                for event, data in iter_sse(response):
+                    if event == "token":
+                        # A new LLM run inside the same node replaces the provisional text
+                        if data["run_id"] != run_id:
+                            run_id, streamed = data["run_id"], ""
+                        streamed += data["content"]
+                        placeholder.markdown(streamed)
+                    elif event == "reply":
+                        reply = data["content"]
+                        placeholder.markdown(reply)
+                    elif event == "end":
+                        reply = data.get("reply") or reply
+                        st.session_state.summary = data.get("summary", "")
+                        st.session_state.version = data.get("version", st.session_state.version)
+                        st.session_state.pending_turn = None
+                    elif event == "error":
+                        if data.get("status") == 409:
+                            refresh_version()
+                        raise requests.RequestException(data["detail"])
+
+            if user_input != "":
+                st.session_state.messages.append({"role": "user", "content": user_input})
+            if reply:
+                st.session_state.messages.append({"role": "assistant", "content": reply})
+            st.session_state.first_run = False
+        except requests.RequestException as e:
+            st.error(f"Error invoking agent: {e}")
 
     st.rerun()
 
@@ -128,22 +158,29 @@ if st.session_state.show_uploader:
     )
 
     if uploaded_files:
-        state.documents_uploaded = True
         st.session_state.documents_uploaded = True
+        progress = {uploaded_file.name: st.empty() for uploaded_file in uploaded_files}
+
+        def show_progress(report):
+            timings = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in report["timings"].items() if seconds)
+            progress[report["name"]].info(f"**{report['name']}**: {report['status']} ({report['stored']}/{report['chunks']} chunks) {timings}")
+
         with st.spinner("Processing files..."):
-            for uploaded_file in uploaded_files:
-                st.info(f"**File name:** {uploaded_file.name}")
-                try:
-                    process_document(uploaded_file)
-                    # response = requests.post(GET_RAG_AGENT_URL, json={}, timeout=500)
-                    # response.raise_for_status()
-                    # print(f"RAG Agent Response: {response.json()}")
-                    # state.RAG_summary = response.json().get("summary", "")
-                    # state.unanswered_questions = response.json().get("unanswered_questions", [])
-                    # print(f"Unanswered Questions: {state.unanswered_questions}")
-                    st.success(f"✅ {uploaded_file.name} processed and stored successfully!")
-                except Exception as e:
-                    st.error(f"❌ Error processing {uploaded_file.name}: {e}")
+            files = [(uploaded_file.name, uploaded_file.getvalue()) for uploaded_file in uploaded_files]
+            # Indexed under the session, which is the namespace its turns search
+            reports = asyncio.run(ingest_files(files, on_progress=show_progress, namespace=st.session_state.session_id))
+            # response = requests.post(GET_RAG_AGENT_URL, json={}, timeout=500)
+            # response.raise_for_status()
+            # print(f"RAG Agent Response: {response.json()}")
+            # state.RAG_summary = response.json().get("summary", "")
+            # state.unanswered_questions = response.json().get("unanswered_questions", [])
+            # print(f"Unanswered Questions: {state.unanswered_questions}")
+
+        for report in reports:
+            if report["status"] == "failed":
+                progress[report["name"]].error(f"❌ Error processing {report['name']}: {report['error']}")
+            else:
+                progress[report["name"]].success(f"✅ {report['name']} processed and stored successfully! ({report['chunks']} chunks)")
 
         # Hide uploader after processing
         st.session_state.show_uploader = False
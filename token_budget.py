@@ -0,0 +1,95 @@
+import os
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict
+
+import logging
+from logging import getLogger
+
+from instrumentation import metrics
+
+try:
+    import tiktoken
+except ImportError:  # fall back to a character heuristic when the tokenizer is not installed
+    tiktoken = None
+
+logger = getLogger("token_budget")
+logger.setLevel(logging.DEBUG)
+
+TOKENIZER_ENCODING = "o200k_base"  # gpt-4o-mini
+PROMPT_TOKEN_CEILING = int(os.getenv("PROMPT_TOKEN_CEILING", "6000"))
+DEFAULT_HISTORY_BUDGET = 2000
+
+# Tokens of conversation history each node may put into its prompt
+NODE_TOKEN_BUDGETS: Dict[str, int] = {
+    "intent_classifier": 800,
+    "gather_information": 2500,
+    "verify_information": 1500,
+    "tools_needed_node": 2000,
+    "check_requirements_node": 2000,
+    "ask_unanswered_questions": 2000,
+    "user_confirmation": 1500,
+    "modify_agents": 2000,
+    "generate_summary": 4000,
+    "get_rag_answer": 400,
+}
+
+# node -> history tokens left out of its prompts to stay within budget
+tokens_saved: Dict[str, int] = defaultdict(int)
+history_tokens_saved = metrics.counter("prompt_history_tokens_saved_total", "Conversation history tokens left out of prompts to fit the node budget", ("node",))
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        # tiktoken downloads its BPE file on first use; offline hosts get the heuristic instead
+        logger.warning("Tokenizer unavailable, estimating tokens from characters: %s", e)
+        return None
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return max(1, len(text) // 4)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoding()
+    if encoding is None:
+        return text[-max_tokens * 4:]
+    tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode(tokens[-max_tokens:])
+
+
+def head_tokens(text: str, max_tokens: int) -> str:
+    # Like truncate_tokens, but keeps the start of the text
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+
+def history_budget(node: str, *prompt_parts: str) -> int:
+    # Whatever the template and the other arguments leave under the ceiling, capped by the node budget
+    reserved = sum(count_tokens(part) for part in prompt_parts if isinstance(part, str))
+    return max(0, min(NODE_TOKEN_BUDGETS.get(node, DEFAULT_HISTORY_BUDGET), PROMPT_TOKEN_CEILING - reserved))
+
+
+def fit_history(node: str, transcript, *prompt_parts: str) -> str:
+    text, used, total = transcript.window(history_budget(node, *prompt_parts))
+    if total > used:
+        tokens_saved[node] += total - used
+        history_tokens_saved.inc(node, amount=total - used)
+        logger.debug("%s: history trimmed from %d to %d tokens (saved %d)", node, total, used, total - used)
+    return text
@@ -0,0 +1,150 @@
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import logging
+from logging import getLogger
+
+import numpy as np
+
+from embedding_cache import cached_embeddings
+
+logger = getLogger("tool_registry")
+logger.setLevel(logging.DEBUG)
+
+TOOLS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tools.json")
+TOP_K = 8
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", (text or "").replace("_", " ").lower())
+
+
+class ToolRegistry:
+    """Tool catalogue loaded from a JSON file of {name: description}, reloaded when the file changes.
+
+    Candidates are ranked with BM25 over an inverted index of names and descriptions and, when an
+    embeddings model is given, cosine similarity against description vectors computed by warm_up() or
+    on the first search after a load.
+    """
+
+    def __init__(self, path: str = TOOLS_PATH, embeddings=None):
+        self.path = path
+        self.embeddings = embeddings
+        self._lock = threading.Lock()
+        self._mtime = None
+        self.tools: Dict[str, str] = {}
+        self.names: List[str] = []
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.average_length = 1.0
+        self.vectors: Optional[np.ndarray] = None
+        self._embedded: Dict[str, np.ndarray] = {}
+
+    def _maybe_reload(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._mtime:
+            return
+        with self._lock:
+            if mtime != self._mtime:
+                self.reload()
+                self._mtime = mtime
+
+    def reload(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            tools = json.load(f)
+
+        postings = defaultdict(list)
+        lengths = []
+        for index, (name, description) in enumerate(tools.items()):
+            terms = Counter(tokenize(f"{name} {description}"))
+            lengths.append(sum(terms.values()))
+            for term, count in terms.items():
+                postings[term].append((index, count))
+
+        self.vectors = None
+        self.tools = tools
+        self.names = list(tools)
+        self.lengths = lengths
+        self.postings = dict(postings)
+        self.average_length = (sum(lengths) / len(lengths)) if lengths else 1.0
+        logger.info("Loaded %d tools from %s", len(tools), self.path)
+
+    async def _ensure_vectors(self, tools: Dict[str, str]) -> Optional[np.ndarray]:
+        """Description vectors for the `tools` snapshot, in its order; a reload while embedding doesn't mix the two."""
+        if self.tools is tools and self.vectors is not None:
+            return self.vectors
+        # Only descriptions that are new since the last load go to the embeddings model
+        texts = [f"{name}: {description}" for name, description in tools.items()]
+        missing = [text for text in texts if text not in self._embedded]
+        if missing:
+            for text, vector in zip(missing, await self.embeddings.aembed_documents(missing)):
+                vector = np.asarray(vector, dtype=np.float32)
+                self._embedded[text] = vector / (np.linalg.norm(vector) or 1.0)
+        vectors = np.stack([self._embedded[text] for text in texts]) if texts else None
+        if self.tools is tools:
+            self.vectors = vectors
+        return vectors
+
+    async def warm_up(self):
+        self._maybe_reload()
+        if self.embeddings is not None:
+            await self._ensure_vectors(self.tools)
+
+    def all(self) -> Dict[str, str]:
+        self._maybe_reload()
+        return dict(self.tools)
+
+    def _bm25(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.names), dtype=np.float32)
+        count = len(self.names)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, frequency in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[index] / self.average_length)
+                scores[index] += idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        return scores
+
+    async def search(self, query: str, k: int = TOP_K, required: Iterable[str] = ()) -> Dict[str, str]:
+        """Top-k tools for the query as {name: description}; required tools are always included."""
+        self._maybe_reload()
+        # Scores, names and vectors all come from the load in place now, even if a reload lands mid-search
+        tools, names = self.tools, self.names
+        if not names:
+            return {}
+
+        scores = self._bm25(query)
+        if scores.max() > 0:
+            scores = scores / scores.max()
+        if self.embeddings is not None:
+            try:
+                vectors = await self._ensure_vectors(tools)
+                query_vector = np.asarray(await self.embeddings.aembed_query(query), dtype=np.float32)
+            except Exception as e:
+                logger.warning("Tool embeddings unavailable, ranking by BM25 only: %s", e)
+            else:
+                query_vector /= np.linalg.norm(query_vector) or 1.0
+                scores = scores + vectors @ query_vector
+
+        k = min(k, len(names))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        selected = {name: tools[name] for name in required if name in tools}
+        for index in top:
+            if len(selected) >= k:
+                break
+            selected.setdefault(names[index], tools[names[index]])
+        return selected
+
+
+tool_registry = ToolRegistry(embeddings=cached_embeddings)
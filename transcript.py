@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from langgraph.config import get_config
+
+from token_budget import count_tokens, truncate_tokens
+
+MAX_CACHED_TRANSCRIPTS = 1024
+
+
+def render_message(message: Dict) -> str:
+    return f"{message['role'].capitalize()}: {message['content']}"
+
+
+class Transcript:
+    """Rendered view of a context_history that formats each message once."""
+
+    def __init__(self, messages: Optional[List[Dict]] = None):
+        self.messages: List[Dict] = []
+        self.lines: List[str] = []
+        self._rendered = ""
+        self._rendered_upto = 0
+        self._token_counts: List[int] = []
+        self._token_total = 0
+        self.generation = 0
+        if messages:
+            self.extend(messages)
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def append(self, message: Dict):
+        self.messages.append(message)
+        self.lines.append(render_message(message))
+
+    def extend(self, messages: List[Dict]):
+        for message in messages:
+            self.append(message)
+
+    def reset(self, messages: List[Dict]):
+        self.messages, self.lines = [], []
+        self._rendered, self._rendered_upto = "", 0
+        self._token_counts, self._token_total = [], 0
+        self.extend(messages)
+
+    def sync(self, messages: List[Dict], generation: int = 0) -> "Transcript":
+        # Nodes only ever append to, truncate or rewrite the tail of the history, so comparing the
+        # first message and the last one we have rendered tells us whether the cached prefix still holds.
+        # Trimming old messages shifts everything, so it bumps `generation` (history_trims) instead.
+        cached = len(self.messages)
+        if (
+            generation == self.generation
+            and cached <= len(messages)
+            and (cached == 0 or (messages[0] == self.messages[0] and messages[cached - 1] == self.messages[-1]))
+        ):
+            self.extend(messages[cached:])
+        else:
+            self.reset(messages)
+            self.generation = generation
+        return self
+
+    def last(self, n: int) -> str:
+        if n <= 0:
+            return ""
+        return "\n".join(self.lines[-n:])
+
+    def since(self, index: int) -> str:
+        return "\n".join(self.lines[index:])
+
+    def token_counts(self) -> List[int]:
+        # Counted lazily, once per message; the +1 accounts for the joining newline
+        for line in self.lines[len(self._token_counts):]:
+            count = count_tokens(line) + 1
+            self._token_counts.append(count)
+            self._token_total += count
+        return self._token_counts
+
+    def window_start(self, max_tokens: int, end: Optional[int] = None) -> int:
+        """Index of the oldest message such that the messages from it up to `end` fit in max_tokens."""
+        counts = self.token_counts()
+        end = len(self.lines) if end is None else end
+        start, used = end, 0
+        while start > 0 and used + counts[start - 1] <= max_tokens:
+            start -= 1
+            used += counts[start]
+        return start
+
+    def window(self, max_tokens: int) -> Tuple[str, int, int]:
+        """Newest messages that fit in max_tokens, as (text, tokens used, tokens of the whole transcript)."""
+        start = self.window_start(max_tokens)
+        used = sum(self.token_counts()[start:])
+        if start == len(self.lines) and self.lines:
+            # Not even the latest message fits: keep its tail rather than sending nothing
+            text = truncate_tokens(self.lines[-1], max_tokens)
+            return text, count_tokens(text), self._token_total
+        return "\n".join(self.lines[start:]), used, self._token_total
+
+    def render(self) -> str:
+        if self._rendered_upto < len(self.lines):
+            new_lines = "\n".join(self.lines[self._rendered_upto:])
+            self._rendered = f"{self._rendered}\n{new_lines}" if self._rendered else new_lines
+            self._rendered_upto = len(self.lines)
+        return self._rendered
+
+
+_transcripts: "OrderedDict[str, Transcript]" = OrderedDict()
+
+
+def transcript_for(context_history: List[Dict], generation: int = 0) -> Transcript:
+    """Transcript for the current graph run, reused across nodes and turns of the same checkpoint thread.
+
+    `generation` is the state's history_trims; a cached transcript from before a trim is rebuilt.
+    """
+    try:
+        thread_id = get_config().get("configurable", {}).get("thread_id")
+    except RuntimeError:
+        thread_id = None
+    if thread_id is None:
+        return Transcript(context_history)
+
+    transcript = _transcripts.get(thread_id)
+    if transcript is None:
+        transcript = _transcripts[thread_id] = Transcript()
+        if len(_transcripts) > MAX_CACHED_TRANSCRIPTS:
+            _transcripts.popitem(last=False)
+    else:
+        _transcripts.move_to_end(thread_id)
+    return transcript.sync(context_history, generation)
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import logging
+from logging import getLogger
+
+from embedding_cache import cached_embeddings
+from instrumentation import metrics
+from numpy_index import NumpyVectorStore, NUMPY_INDEX_DIR
+
+logger = getLogger("vector_store")
+logger.setLevel(logging.DEBUG)
+
+DEFAULT_K = 3
+VERSION_PATH = "vector_store.version"
+# "default" uses whatever Initialize_vector_store connects to, "numpy" the embedded index in NUMPY_INDEX_DIR
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "default")
+DEFAULT_NAMESPACE = "default"
+NAMESPACE_DIR = os.path.join(NUMPY_INDEX_DIR, "namespaces")
+VECTOR_MEMORY_BUDGET_MB = int(os.getenv("VECTOR_MEMORY_BUDGET_MB", "512"))
+SAFE_NAMESPACE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+store_loads = metrics.counter("vector_store_loads_total", "Vector indexes opened from disk")
+store_evictions = metrics.counter("vector_store_evictions_total", "Vector indexes dropped from memory to stay within the budget")
+
+
+def namespace_key(namespace: Optional[str]) -> str:
+    """Directory-safe name of a namespace; None is the shared default index."""
+    if not namespace:
+        return DEFAULT_NAMESPACE
+    # Namespaces are session ids or tenant headers, so anything that is not a plain name is hashed
+    return namespace if SAFE_NAMESPACE.fullmatch(namespace) else hashlib.sha1(namespace.encode("utf-8")).hexdigest()
+
+
+class VersionFile:
+    """Counter in a small file, so that ingestion in another process invalidates copies held here."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._value = 0
+        self._mtime = None
+
+    @property
+    def value(self) -> int:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return self._value
+        if mtime != self._mtime:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._value = int(f.read().strip() or 0)
+            self._mtime = mtime
+        return self._value
+
+    def bump(self) -> int:
+        value = self.value + 1
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(str(value))
+        self._value = value
+        return value
+
+
+class VectorStoreManager:
+    """Opens each namespace's vector store on first use and reopens it only after new content is ingested.
+
+    With the numpy backend every namespace (a tenant or a session) is its own index under
+    NAMESPACE_DIR, so a search only scans that customer's documents. Open indexes are kept in LRU
+    order and the least recently used are dropped once their total size passes `memory_budget`
+    bytes; they are loaded from disk again on their next search. The shared "default" backend has a
+    single collection, in which namespaced chunks carry a "namespace" metadata field to filter on.
+
+    Version counters live in small files so that ingestion in another process (the Streamlit
+    client) invalidates the copies held by the API workers.
+    """
+
+    def __init__(self, version_path: str = VERSION_PATH, backend: str = VECTOR_STORE_BACKEND, namespace_dir: str = NAMESPACE_DIR, memory_budget: int = VECTOR_MEMORY_BUDGET_MB * 2 ** 20):
+        self.version_path = version_path
+        self.backend = backend
+        self.namespace_dir = namespace_dir
+        self.memory_budget = memory_budget
+        self._lock = threading.RLock()
+        # namespace -> {"store", "version", "bytes"}, least recently used first
+        self.resident: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._versions: Dict[str, VersionFile] = {}
+
+    @property
+    def partitioned(self) -> bool:
+        return self.backend == "numpy"
+
+    def _key(self, namespace: Optional[str]) -> str:
+        # The shared backend has one store for all namespaces
+        return namespace_key(namespace) if self.partitioned else DEFAULT_NAMESPACE
+
+    def _version_file(self, key: str) -> VersionFile:
+        version_file = self._versions.get(key)
+        if version_file is None:
+            path = self.version_path if key == DEFAULT_NAMESPACE else os.path.join(self.namespace_dir, key, "version")
+            version_file = self._versions.setdefault(key, VersionFile(path))
+        return version_file
+
+    @property
+    def version(self) -> int:
+        return self._version_file(DEFAULT_NAMESPACE).value
+
+    def get_store(self, namespace: Optional[str] = None):
+        key = self._key(namespace)
+        version = self._version_file(key).value
+        with self._lock:
+            entry = self.resident.get(key)
+            if entry is None or entry["version"] != version:
+                logger.info("Opening vector store %s (version %d)", key, version)
+                store = self._open(key)
+                entry = self.resident[key] = {"store": store, "version": version, "bytes": getattr(store, "nbytes", 0)}
+                store_loads.inc()
+                self._evict(keep=key)
+            self.resident.move_to_end(key)
+        return entry["store"]
+
+    def _open(self, key: str):
+        if not self.partitioned:
+            return self._connect()
+        path = NUMPY_INDEX_DIR if key == DEFAULT_NAMESPACE else os.path.join(self.namespace_dir, key)
+        return NumpyVectorStore(cached_embeddings, path)
+
+    def _connect(self):
+        # The RAG utilities pull in the vector database client, so they are imported on first use
+        from requirements_agent.utils.rag import Initialize_vector_store
+
+        return Initialize_vector_store()
+
+    def _evict(self, keep: str):
+        total = sum(entry["bytes"] for entry in self.resident.values())
+        for key in list(self.resident):
+            if total <= self.memory_budget:
+                break
+            if key == keep:
+                continue
+            # Searches still holding the store finish on it; it is freed once they are done
+            total -= self.resident.pop(key)["bytes"]
+            store_evictions.inc()
+            logger.info("Evicted vector store %s, %d bytes resident", key, total)
+
+    def search_kwargs(self, namespace: Optional[str] = None) -> Dict[str, Any]:
+        if self.partitioned or not namespace:
+            return {}
+        return {"filter": {"namespace": namespace_key(namespace)}}
+
+    async def asearch_batch(self, queries: List[str], k: int = DEFAULT_K, namespace: Optional[str] = None) -> List[list]:
+        """Documents of `namespace` for each query, with the queries embedded together."""
+        if not queries:
+            return []
+        store = self.get_store(namespace)
+        vectors = await cached_embeddings.aembed_queries(queries)
+        return await asyncio.gather(*(store.asimilarity_search_by_vector(vector, k=k, **self.search_kwargs(namespace)) for vector in vectors))
+
+    def invalidate(self, namespace: Optional[str] = None) -> int:
+        with self._lock:
+            return self._version_file(self._key(namespace)).bump()
+
+
+vector_stores = VectorStoreManager()
+
+
+def process_document(uploaded_file, namespace: Optional[str] = None):
+    if vector_stores.backend == "numpy" or namespace:
+        # The embedded index is only written to by our own pipeline, as are namespaced chunks, which need tagging
+        from ingestion import ingest_files
+
+        return asyncio.run(ingest_files([(uploaded_file.name, uploaded_file.getvalue())], namespace=namespace))
+    from requirements_agent.utils.rag import process_document as ingest_document
+
+    result = ingest_document(uploaded_file)
+    vector_stores.invalidate()
+    return result
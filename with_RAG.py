@@ -1,24 +1,35 @@
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict
-from langgraph.graph import StateGraph, END, START
+from langgraph.graph import END, START
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 from requirements_agent.prompts.prompt import *
 from pydantic import BaseModel, Field
 from typing import Optional, List, Annotated
-from llm import llm
+from llm import gateway
+from transcript import transcript_for
+from token_budget import fit_history
+from prompt_encoding import encode_checklist, encode_summary, render
+from instrumentation import InstrumentedStateGraph
+from rolling_summary import UPDATE_SUMMARY_PROMPT, full_summary_history, needs_full_summary, tail_rewritten
+from checklist import CategoryPrefilter, is_complete, next_open, partial_schema, to_mask
 from langgraph.graph.message import add_messages
 from langgraph.types import interrupt, Command
 import logging
 from logging import getLogger
 
-from requirements_agent.ag2 import RAGAgent
-from requirements_agent.utils.rag import Initialize_vector_store, embeddings
+from rag_jobs import rag_output, run_rag_analysis
+from pre_answer import pre_answer_questions, next_open_question, answered_summary
+from vector_store import vector_stores
 
+import asyncio
 import base64
+import importlib.util
+import os
 from io import BytesIO
 import json
 import re
-from collections import defaultdict
+import time
+from functools import lru_cache
 
 logger = getLogger("onboarding_agent")
 logger.setLevel(logging.DEBUG)
@@ -27,12 +38,24 @@ formatter = logging.Formatter(
     fmt='[%(asctime)s] [%(name)s] [%(levelname)s] - %(message)s',
     datefmt='%Y-%m-%d %H:%M:%S'
 )
-
-with open('requirements_agent/topics.json', 'r', encoding='utf-8') as f:
-    categories = json.load(f)
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    handler.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+    logger.addHandler(handler)
+
+def topics_path() -> str:
+    # Next to the requirements_agent package, wherever it is installed, rather than relative to the working directory
+    spec = importlib.util.find_spec("requirements_agent")
+    return os.getenv("TOPICS_PATH") or os.path.join(list(spec.submodule_search_locations)[0], "topics.json")
+
+@lru_cache(maxsize=1)
+def load_topics() -> Dict[str, object]:
+    with open(topics_path(), 'r', encoding='utf-8') as f:
+        return json.load(f)
 
 def get_subtopics(category_name):
-    subtopics = categories.get(category_name)
+    subtopics = load_topics().get(category_name)
     if subtopics is not None:
         return subtopics
     else:
@@ -42,6 +65,12 @@ def get_subtopics(category_name):
 def override(_, new):
     return new
 
+MAX_RAG_HOPS = 3
+RAG_DEADLINE_SECONDS = 20.0
+RAG_HOP_LOG_LIMIT = 50
+# Tokens of the RAG summary a full summary regeneration is given
+RAG_SUMMARY_TOKENS = 1500
+
 class BusinessInfoChecklist(BaseModel):
     business_overview: bool = False
     industry_domain: bool = False
@@ -66,6 +95,17 @@ class BusinessInfoChecklist(BaseModel):
     international_business_considerations: bool = False
     exit_strategy_succession_planning: bool = False
 
+CHECKLIST_FIELDS = tuple(BusinessInfoChecklist.model_fields)
+CHECKLIST_BITS = {field: index for index, field in enumerate(CHECKLIST_FIELDS)}
+
+@lru_cache(maxsize=1)
+def category_filter() -> CategoryPrefilter:
+    return CategoryPrefilter(CHECKLIST_FIELDS, load_topics())
+
+def covered(state: "AgentState") -> int:
+    # Sessions started before checklist_mask existed, and clients that only send data, still carry their progress there
+    return state.checklist_mask | to_mask(state.data, CHECKLIST_FIELDS)
+
 class OnboardingResponse(BaseModel):
     intro: bool = False
     response: str = ""
@@ -89,10 +129,17 @@ class AgentState(BaseModel):
     RAG:bool = False
     RAG_summary: str = ""
     unanswered_questions: List[dict] = []
+    question_answers: List[dict] = [] # what the documents say for each of unanswered_questions
+    answers_confirmed: bool = False
     query: str = ""
     context_history: Annotated[list[dict], override] =[]
     summary: str = ""
+    summary_upto: int = 0
+    summary_turns: int = 0
+    history_trims: int = 0 # times old messages were dropped from context_history to bound the state size
+    refresh_summary: bool = False
     data: BusinessInfoChecklist = BusinessInfoChecklist()
+    checklist_mask: int = 0 # bit i set once CHECKLIST_FIELDS[i] is covered
     user_confirmation: bool = False
     suggested_agents: str = ""
     all_questions_answered: bool = False
@@ -103,17 +150,31 @@ class AgentState(BaseModel):
     new_context_history: Annotated[list[dict], override] = []
     team_information: bool = False
     agent_suggested: bool = False
+    rag_hops: List[dict] = [] # questions the agent answered from the documents instead of asking the user
+    namespace: Optional[str] = None # vector index holding this tenant's or session's documents; None is the shared one
 
 def extract_team_info(summary: str) -> str:
     match = re.search(r"- \*\*Team Information\*\*:[\s\S]*", summary)
     return match.group(0).strip() if match else ""
 
 class OnboardingAgent:
-    def __init__(self):
+    USER_FACING_NODES = ("GatherInformation", "AskUnansweredQuestions", "UserConfirmation", "SuggestAgents", "ModifyAgents")
+
+    def __init__(self, checkpointer=None, defer_summary: bool = False, incremental_verification: bool = True, max_rag_hops: int = MAX_RAG_HOPS, rag_deadline_seconds: float = RAG_DEADLINE_SECONDS):
+        self.checkpointer = checkpointer
+        self.defer_summary = defer_summary
+        self.incremental_verification = incremental_verification
+        self.max_rag_hops = max_rag_hops
+        self.rag_deadline_seconds = rag_deadline_seconds
         self.graph = self.build_graph()
 
+    def warm_up(self):
+        # Parsed once per process; later agents and turns reuse them
+        load_topics()
+        category_filter()
+
     def build_graph(self):
-        builder = StateGraph(AgentState)
+        builder = InstrumentedStateGraph(AgentState, graph_name="with_RAG")
 
         builder.add_node("GatherInformation", self.gather_information)
         builder.add_node("VerifyInformation", self.verify_information)
@@ -143,7 +204,7 @@ class OnboardingAgent:
         # builder.add_edge("GatherInformation", "GenerateSummary")
         # builder.add_conditional_edges("GenerateSummary",self.confirmation_route, {"SuggestAgents": "SuggestAgents", "END": END})
 
-        return builder.compile()
+        return builder.compile(checkpointer=self.checkpointer)
 
     def check_documents_uploaded(self, state: AgentState) -> str:
 
@@ -166,7 +227,7 @@ class OnboardingAgent:
 
     def route(self, state: AgentState) -> str:
 
-        if all(state.data.dict().values()):
+        if is_complete(covered(state), len(CHECKLIST_FIELDS)):
             return "UserConfirmation"
         else:
             return "GatherInformation"
@@ -177,28 +238,17 @@ class OnboardingAgent:
         else:
             return "END"
 
-    def gather_information(self, state: AgentState) -> AgentState:
+    async def gather_information(self, state: AgentState) -> AgentState:
         logger.info("Gathering information")
-        print("Gathering information")
-
-        formatted_context_history = ""
-        if state.context_history:
-            for message in state.context_history[-16:]:
-                role = message["role"].capitalize()
-                content = message["content"]
-                formatted_context_history += f"{role}: {content}\n"
-
-        checklist_dict = state.data.dict()
-        first_false_key = None
-        for key, value in checklist_dict.items():
-            if value is False:
-                first_false_key = key
-                break
+
+        formatted_context_history = fit_history("gather_information", transcript_for(state.context_history, state.history_trims), ASK_FOLLOWUP_QUESTION_PROMPT)
+
+        first_false_key = self.current_category(state)
 
         subs= get_subtopics(first_false_key)
-        print(f"\nSubtopics: {subs}\n")
+        logger.debug("Subtopics: %s", subs)
 
-        print(f"\nFirst False Key: {first_false_key}\n")
+        logger.debug("Current category: %s", first_false_key)
         prompt=ASK_FOLLOWUP_QUESTION_PROMPT.format(
             context_history=formatted_context_history,
             current_category=first_false_key,
@@ -206,225 +256,288 @@ class OnboardingAgent:
         )
 
         messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
-        print(f"\n Response: {response} \n")
+        response = await gateway.ainvoke(messages)
+        logger.debug("Response: %s", response)
         context_history = state.context_history.copy()
         context_history.append({"role": "assistant", "content": response.content})
 
         return {"context_history": context_history}
 
-    def ask_unanswered_questions(self, state: AgentState) -> AgentState:
-        print("Asking unanswered questions")
+    async def ask_unanswered_questions(self, state: AgentState) -> AgentState:
+        logger.info("Asking unanswered questions")
 
         context_history = state.context_history.copy()
         context_history.append({"role": "user", "content": state.query})
         intro = state.intro
         is_first_message = state.is_first_message
 
+        rag_hops = list(state.rag_hops)
+        turn = len(state.context_history)
         if not intro:
             summary = state.summary if state.summary else state.RAG_summary
             team_info = extract_team_info(summary)
-            print(team_info)
-
-            prompt = ASK_ONBOARDING_PROMPT.format(
-                business_summary=f" {summary[:300]}\n TeamStructure information: {team_info}",
-                context_history="\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in context_history] if context_history else ""),
-            )
-            print(f"\nPromp set")
-            structured_llm = llm.with_structured_output(OnboardingResponse)
-            messages = [AIMessage(content=prompt)]
-            response = structured_llm.invoke(messages)
-            print(f"\n Response: {response} \n")
-            intro = response.intro
-
-            if not intro:
-                if len(context_history) >=5:
-                    answer = self.get_rag_answer(response.response,context_history = context_history[-4:])
-                    print(answer)
-                    if answer.status:
-                        context_history.append({"role": "assistant asking from RAG Agent", "content": response.response, "assistant":"assistant_to_docs"})
-                        context_history.append({"role": "RAG Agent Response", "content": answer.response})
-
-                        state.context_history = context_history
-                        state.intro = intro
-
-                        return self.ask_unanswered_questions(state)
-
-                    else:
-                        context_history.append({"role": "assistant", "content": response.response})
-                        return {"context_history": context_history, "intro": intro}
+            logger.debug("Team information: %s", team_info)
+            business_summary = f" {summary[:300]}\n TeamStructure information: {team_info}"
+
+            # Questions the documents can answer are resolved here, within a hop budget and a deadline
+            deadline = time.monotonic() + self.rag_deadline_seconds
+            for hop in range(self.max_rag_hops + 1):
+                prompt = ASK_ONBOARDING_PROMPT.format(
+                    business_summary=business_summary,
+                    context_history=fit_history("ask_unanswered_questions", transcript_for(context_history, state.history_trims), ASK_ONBOARDING_PROMPT, business_summary),
+                )
+                messages = [AIMessage(content=prompt)]
+                if hop == 0:
+                    response = await gateway.ainvoke(messages, OnboardingResponse)
                 else:
+                    # Follow-up questions share the deadline; past it, the turn ends on the answers found so far
+                    try:
+                        response = await asyncio.wait_for(gateway.ainvoke(messages, OnboardingResponse), max(deadline - time.monotonic(), 0))
+                    except asyncio.TimeoutError:
+                        logger.info("RAG hop %d follow-up question hit the deadline", hop)
+                        return {"context_history": context_history, "intro": intro, "rag_hops": rag_hops}
+                logger.debug("Response: %s", response)
+                intro = response.intro
+                if intro:
+                    break
+
+                remaining = deadline - time.monotonic()
+                answer = None
+                if len(context_history) >= 5 and hop < self.max_rag_hops and remaining > 0:
+                    started = time.monotonic()
+                    try:
+                        answer = await asyncio.wait_for(self.answer_from_documents(response.response, state.query, context_history, state.namespace, state.history_trims), remaining)
+                    except asyncio.TimeoutError:
+                        logger.info("RAG hop %d hit the deadline", hop)
+                    logger.debug("RAG answer: %s", answer)
+                    rag_hops.append({
+                        "turn": turn,
+                        "hop": hop,
+                        "question": response.response,
+                        "answered": bool(answer and answer.status),
+                        "seconds": round(time.monotonic() - started, 3),
+                    })
+                    rag_hops = rag_hops[-RAG_HOP_LOG_LIMIT:]
+
+                if answer is None or not answer.status:
                     context_history.append({"role": "assistant", "content": response.response})
-                    return {"context_history": context_history, "intro": intro}
+                    return {"context_history": context_history, "intro": intro, "rag_hops": rag_hops}
+
+                context_history.append({"role": "assistant asking from RAG Agent", "content": response.response, "assistant":"assistant_to_docs"})
+                context_history.append({"role": "RAG Agent Response", "content": answer.response})
             # if intro:
             #     intro = response.intro
 
         if intro:
             question_index = state.question_index
-
-            print("Intro has been completed")
-
-            if question_index >= len(state.unanswered_questions):
+            answers_confirmed = state.answers_confirmed
+
+            logger.info("Intro has been completed")
+
+            # Questions the documents already answer are skipped, and confirmed together in a single turn
+            found = answered_summary(state.unanswered_questions, state.question_answers)
+            next_index = next_open_question(state.unanswered_questions, state.question_answers, question_index)
+            if found and not answers_confirmed:
+                current_category = "Answers found in your documents"
+                current_subtopics = "Ask the user to confirm or correct these answers taken from their documents:\n" + "\n".join(f"- {question} {answer}" for question, answer in found.items())
+                answers_confirmed = True
+                question_index = next_index
+            elif next_index >= len(state.unanswered_questions):
                 current_category = "Completed"
                 current_subtopics = "no more questions"
+                question_index = next_index + 1
             else:
                 # Get the next question
-                next_q = state.unanswered_questions[question_index]
+                next_q = state.unanswered_questions[next_index]
                 current_category = next_q["section"]
                 current_subtopics = next_q["question"]
+                question_index = next_index + 1
 
-            prompt=ASK_FOLLOWUP_QUESTION_PROMPT3.format(
+            # Like the intro questions, a follow-up question only needs the opening of the RAG summary
+            business_summary = encode_summary(state.RAG_summary)
+            prompt=render(
+                "ASK_FOLLOWUP_QUESTION_PROMPT3", ASK_FOLLOWUP_QUESTION_PROMPT3,
+                raw={"business_summary": state.RAG_summary},
                 # is_first_message=is_first_message,
-                business_summary=state.RAG_summary,
+                business_summary=business_summary,
                 current_category=current_category,
                 current_subtopics=current_subtopics,
-                context_history= "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in context_history[-10:]] if context_history else ""),
+                context_history= fit_history("ask_unanswered_questions", transcript_for(context_history, state.history_trims), ASK_FOLLOWUP_QUESTION_PROMPT3, business_summary, str(current_subtopics)),
             )
 
-            structured_llm = llm.with_structured_output(AskUnansweredQuestions)
             messages = [AIMessage(content=prompt)]
-            response = structured_llm.invoke(messages)
-            print(f"\n Response: {response} \n")
+            response = await gateway.ainvoke(messages, AskUnansweredQuestions)
+            logger.debug("Response: %s", response)
             
-            question_index += 1
             is_first_message = False
 
             if not response.all_questions_answered:
                 context_history.append({"role": "assistant", "content": response.response})
-            return {"context_history": context_history,"question_index": question_index,"all_questions_answered": response.all_questions_answered,"intro": intro,"is_first_message": is_first_message}
+            return {"context_history": context_history,"question_index": question_index,"all_questions_answered": response.all_questions_answered,"intro": intro,"is_first_message": is_first_message,"rag_hops": rag_hops,"answers_confirmed": answers_confirmed}
 
-    def verify_information(self,state: AgentState) -> AgentState:
-        print("Verifying information")
+    def current_category(self, state: AgentState) -> Optional[str]:
+        index = next_open(covered(state), len(CHECKLIST_FIELDS))
+        return CHECKLIST_FIELDS[index] if index is not None else None
+
+    async def verify_information(self,state: AgentState) -> AgentState:
+        logger.info("Verifying information")
 
         context_history = state.context_history.copy()
         context_history.append({"role": "user", "content": state.query})
 
-        formatted_context_history = ""
-        if context_history:
-            for message in context_history[-10:]:
-                role = message["role"].capitalize()
-                content = message["content"]
-                formatted_context_history += f"{role}: {content}\n"
-
-        checklist_dict = state.data.dict()
-        first_false_key = None
-        for key, value in checklist_dict.items():
-            if value is False:
-                first_false_key = key
-                break
-
-        prompt=VERIFY_INFORMATION_PROMPT.format(
+        formatted_context_history = fit_history("verify_information", transcript_for(context_history, state.history_trims), VERIFY_INFORMATION_PROMPT)
+
+        first_false_key = self.current_category(state)
+        if first_false_key is None:
+            return {"context_history": context_history}
+
+        if self.incremental_verification:
+            # Judge the active category plus the open ones this message plausibly touches
+            selected = 1 << CHECKLIST_BITS[first_false_key]
+            for index in category_filter().candidates(state.query, covered(state)):
+                selected |= 1 << index
+            fields = tuple(field for index, field in enumerate(CHECKLIST_FIELDS) if selected >> index & 1)
+            schema = partial_schema(f"ChecklistUpdate_{selected:x}", fields)
+            current_checklist = {field: False for field in fields}
+        else:
+            schema = BusinessInfoChecklist
+            current_checklist = state.data.dict()
+
+        prompt=render(
+            "VERIFY_INFORMATION_PROMPT", VERIFY_INFORMATION_PROMPT,
+            raw={"current_checklist": current_checklist},
             conversation_history=formatted_context_history,
-            current_checklist=state.data.dict(),
+            current_checklist=encode_checklist(current_checklist),
             current_category=first_false_key
         )
 
         messages = [AIMessage(content=prompt)]
-        structured_llm = llm.with_structured_output(BusinessInfoChecklist)
-        response = structured_llm.invoke(messages)
-        print(f"\n Verification Response: {response} \n")
+        response = await gateway.ainvoke(messages, schema, cache_node="verify_information")
+        logger.debug("Verification response: %s", response)
         if isinstance(response, dict):
-            response = BusinessInfoChecklist(**response)
+            response = schema(**response)
+
+        if self.incremental_verification:
+            mask = covered(state)
+            for field, value in response.dict().items():
+                if value:
+                    mask |= 1 << CHECKLIST_BITS[field]
+            data = BusinessInfoChecklist(**{field: bool(mask >> index & 1) for index, field in enumerate(CHECKLIST_FIELDS)})
+        else:
+            data = response
+            mask = to_mask(response, CHECKLIST_FIELDS)
 
-        return {"data": response, "context_history": context_history}
+        return {"data": data, "checklist_mask": mask, "context_history": context_history}
 
-    def generate_summary(self, state: AgentState) -> str:
+    async def generate_summary(self, state: AgentState) -> str:
+        # SuggestAgents reads the summary, so it is only deferred when the turn ends here
+        if self.defer_summary and self.confirmation_route(state) == "END":
+            return {}
+        return await self.summarize(state)
 
-        print("Generating summary")
+    async def summarize(self, state: AgentState) -> dict:
+
+        logger.info("Generating summary")
+
+        if state.summary_upto == len(state.context_history) and state.summary and not state.refresh_summary:
+            return {}
+
+        transcript = transcript_for(state.context_history, state.history_trims)
+        if needs_full_summary(state.summary, state.summary_upto, state.summary_turns, state.context_history, state.refresh_summary):
+            rag_summary = encode_summary(state.RAG_summary, RAG_SUMMARY_TOKENS)
+            formatted_context_history = await full_summary_history(gateway, "generate_summary", transcript, state.summary, state.summary_upto, GENERATE_SUMMARY_PROMPT, rag_summary)
+            prompt = render(
+                "GENERATE_SUMMARY_PROMPT", GENERATE_SUMMARY_PROMPT,
+                raw={"RAG_summary": state.RAG_summary},
+                context_history=formatted_context_history,
+                RAG_summary=rag_summary,
+            )
+            summary_turns = 0
+        else:
+            # Fold only the messages since the last summary into it
+            prompt = UPDATE_SUMMARY_PROMPT.format(
+                summary=state.summary,
+                new_messages=transcript.since(state.summary_upto),
+                details="",
+            )
+            summary_turns = state.summary_turns + 1
 
-        formatted_context_history = ""
-        if state.context_history:
-            for message in state.context_history:
-                role = message["role"].capitalize()
-                content = message["content"]
-                formatted_context_history += f"{role}: {content}\n"
-        
-        prompt = GENERATE_SUMMARY_PROMPT.format(
-            context_history=formatted_context_history,
-            RAG_summary=state.RAG_summary,
-        )
-        
         messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
+        response = await gateway.ainvoke(messages)
 
-        return {"summary": response.content}
+        return {"summary": response.content, "summary_upto": len(state.context_history), "summary_turns": summary_turns, "refresh_summary": False}
 
-    def user_confirmation(self, state: AgentState) -> AgentState:
-        print("\n \n In User confirmation")
+    async def user_confirmation(self, state: AgentState) -> AgentState:
+        logger.info("In user confirmation")
 
         context_history = state.context_history.copy()
         last_message = context_history[-1]
         if last_message["role"] != "user":
             context_history.append({"role": "user", "content": state.query})
 
-        print(f"\nContext History: {context_history}\n")
         prompt = USER_CONFIRMATION_PROMPT.format(
-            context_history="\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in context_history[-10:]] if context_history else "")
+            context_history=fit_history("user_confirmation", transcript_for(context_history, state.history_trims), USER_CONFIRMATION_PROMPT)
         )
 
         messages = [AIMessage(content=prompt)]
-        structured_llm = llm.with_structured_output(UserConfirmation)
-        response = structured_llm.invoke(messages)
-        print(f"\n User Confirmation: {response}")
+        response = await gateway.ainvoke(messages, UserConfirmation, cache_node="user_confirmation")
+        logger.debug("User confirmation: %s", response)
 
         context_history.append({"role": "assistant", "content": response.response})
         return {"context_history": context_history, "user_confirmation": response.user_confirmation}
 
-    def suggest_agents(self, state: AgentState) -> AgentState:
-        print("\n \n In Suggest Agents")
+    async def suggest_agents(self, state: AgentState) -> AgentState:
+        logger.info("In suggest agents")
         context_history = state.context_history.copy()
 
         prompt = SUGGEST_AGENTS_PROMPT.format(
             summary=state.summary
         )
-        response = llm.invoke([AIMessage(content=prompt)])
+        response = await gateway.ainvoke([AIMessage(content=prompt)])
 
-        print(f"Suggest Agents Response: {response}")
+        logger.debug("Suggest agents response: %s", response)
 
         context_history=context_history[:-1]  # Remove the last assistant message
         context_history.append({"role": "assistant", "content": response.content, "assistant": "suggest_agent"})
         # Implement your agent suggestion logic here
-        return {"context_history": context_history, "suggested_agents": response.content, "agent_suggested": True}
+        return {"context_history": context_history, "suggested_agents": response.content, "agent_suggested": True, **tail_rewritten(state.summary_upto, len(context_history) - 1)}
 
-    def rag_based_agent(self, state: AgentState) -> AgentState:
-        print("\n \n In RAG Based Agent")
+    async def rag_based_agent(self, state: AgentState) -> AgentState:
+        logger.info("In RAG based agent")
 
-        results = {}
-        rag_agent = RAGAgent()
-        while True:
-            results = rag_agent.graph.invoke(results)
-            if results.get("breakpoint", False):
-                break
+        results = await run_rag_analysis()
+        return await self.with_pre_answers(rag_output(results), state.namespace)
 
-        return {"RAG_summary": results.get("summary", ""), "unanswered_questions": results.get("unanswered_questions", []), "breakpoint": results.get("breakpoint", False)}
+    async def with_pre_answers(self, output: dict, namespace: Optional[str] = None) -> dict:
+        answers = await pre_answer_questions(gateway, output["unanswered_questions"], namespace=namespace)
+        return {**output, "question_answers": answers, "answers_confirmed": False}
 
         messages = [AIMessage(content=prompt)]
-        response = llm.invoke(messages)
+        response = await gateway.ainvoke(messages)
 
         context_history.append({"role": "assistant", "content": response.content})
         return {"context_history": context_history, "rag_answer": response.content}
 
-    def modify_agents(self,state: AgentState) -> AgentState:
+    async def modify_agents(self,state: AgentState) -> AgentState:
 
-        print("In Modifying the Agents Node")
+        logger.info("In modify agents")
         context_history = state.context_history.copy()
         try:
             if context_history and not context_history[-1].get("assistant"):
-                print("updating the context_history")
+                logger.debug("Appending the user query to context_history")
                 context_history.append({"role": "user", "content": state.query})
         except Exception as e:
-            print(f"Error occurred: {e}")
+            logger.error("Error occurred: %s", e)
 
         prompt=MODIFY_AGENTS_PROMPT.format(
             summary=state.summary,
             suggested_agents=state.suggested_agents,
-            context_history= "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in context_history[-14:]] if context_history else ""),
+            context_history= fit_history("modify_agents", transcript_for(context_history, state.history_trims), MODIFY_AGENTS_PROMPT, state.summary, state.suggested_agents),
         )
 
         messages = [AIMessage(content=prompt)]
-        structured_llm = llm.with_structured_output(UserConfirmation)
-        response = structured_llm.invoke(messages)
-        print(f"\n Modify Agents: {response}")
+        response = await gateway.ainvoke(messages, UserConfirmation)
+        logger.debug("Modify agents: %s", response)
         
         context_history.append({"role": "assistant", "content": response.response})
         return {"context_history": context_history}
@@ -436,21 +549,26 @@ class OnboardingAgent:
         img_str     = base64.b64encode(image_buf.getvalue()).decode("utf-8")
         return {"selection_agent_base64": f"data:image/png;base64,{img_str}"}
 
-    def get_rag_answer(self, question: str, context_history: Optional[List[Dict]] = None) -> RAGResponse:
+    async def answer_from_documents(self, question: str, user_message: str, context_history: List[Dict], namespace: Optional[str] = None, history_trims: int = 0) -> RAGResponse:
+        # The question and the message it follows up on are retrieved together in one batch
+        results = await vector_stores.asearch_batch([question, user_message] if user_message else [question], k=3, namespace=namespace)
+        documents = list(dict.fromkeys(doc.page_content.strip() for docs in results for doc in docs))
+        return await self.get_rag_answer(question, context_history=context_history, retrieved_text="\n".join(documents), history_trims=history_trims)
+
+    async def get_rag_answer(self, question: str, context_history: Optional[List[Dict]] = None, retrieved_text: Optional[str] = None, namespace: Optional[str] = None, history_trims: int = 0) -> RAGResponse:
 
-        vector_store = Initialize_vector_store()
-        retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-        retrieved_docs = retriever.invoke(question)
-        retrieved_text = "\n".join([doc.page_content.strip() for doc in retrieved_docs])
-        print(retrieved_text)
+        if retrieved_text is None:
+            # Retrieval goes through the embedding cache, so a repeated question is not embedded again
+            retrieved_docs = (await vector_stores.asearch_batch([question], k=3, namespace=namespace))[0]
+            retrieved_text = "\n".join([doc.page_content.strip() for doc in retrieved_docs])
+        logger.debug("Retrieved %d characters for %r", len(retrieved_text), question)
         prompt = RAG_BASED_AGENT_PROMPT.format(
             query=question,
             data=retrieved_text,
-            context_history="\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in context_history] if context_history else ""),
+            context_history=fit_history("get_rag_answer", transcript_for(context_history or [], history_trims), RAG_BASED_AGENT_PROMPT, question, retrieved_text),
         )
         messages = [AIMessage(content=prompt)]
-        structured_llm = llm.with_structured_output(RAGResponse)
-        response = structured_llm.invoke(messages)
+        response = await gateway.ainvoke(messages, RAGResponse)
         return response
 
 if __name__ == "__main__":